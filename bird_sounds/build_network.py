@@ -2,6 +2,10 @@ import json
 from pathlib import Path
 
 from bird_sounds import helper_functions
+from common import data_loading
+from common import spectrogram_cache
+from common.evaluation import Evaluator
+from common.mixed_precision import TrainingPrecision, report_precision
 import torch
 from torch import nn
 from torch import optim
@@ -11,107 +15,156 @@ from matplotlib import pyplot as plt
 
 model_name = 'Modified_AlexNet'
 metadata_file = 'ff1010bird_metadata.csv'
-
-# Start model definition
-if model_name == 'AlexNet':
-    model = models.AlexNet(num_classes=1)
-elif model_name == 'Modified_AlexNet':
-    model = helper_functions.AlexNet(num_classes=1)
-elif model_name == 'resnet101':
-    model = models.resnet101(num_classes=1)
-elif model_name == 'resnet18':
-    model = models.resnet18(num_classes=1)
-
 device = 'cuda'
-
-transformations = transforms.transforms.Compose([
-    transforms.transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                    std=[0.229, 0.224, 0.225])
-])
-
-train_loader = torch.utils.data.DataLoader(
-    helper_functions.BirdCalls(Path('../bird_sounds/' + metadata_file), False,
-                               x_size=224, y_size=224,
-                               transformations=transformations),
-    batch_size=16)
-
-test_loader = torch.utils.data.DataLoader(
-    helper_functions.BirdCalls(Path('../bird_sounds/' + metadata_file), True,
-                               x_size=224, y_size=224,
-                               transformations=transformations),
-    batch_size=50)
-
-optimizer = optim.SGD(model.parameters(), lr=0.0005, momentum=0.9)
-criterion = nn.BCEWithLogitsLoss()
-model.to(device)
-
-epochs = 40
-steps = 0
-running_loss = 0
-save_every = 5
-train_losses = []
-test_losses = []
-accuracies = []
-metadata = {}
-
-for epoch in range(epochs):
+# DataLoader workers, pinned memory and prefetching, see common.data_loading
+loader_config = {'num_workers': None, 'pin_memory': None, 'persistent_workers': True, 'prefetch_factor': 2}
+# fill the spectrogram cache in parallel before the first epoch instead of during it
+precompute_spectrograms = True
+# 'torch' loads raw audio and computes the mel spectrograms of each collated batch on the device instead of librosa
+frontend = 'librosa'
+# 'bf16' trains under autocast in bfloat16 with channels_last inputs, 'fp16' in float16 with a gradient scaler on cuda
+precision = 'fp32'
+# print the step time and memory (peak on cuda, saved activations on cpu) of precision against fp32 on the first batch
+compare_precision = False
+
+
+def create_model(model_name):
+    if model_name == 'AlexNet':
+        return models.AlexNet(num_classes=1)
+    elif model_name == 'Modified_AlexNet':
+        return helper_functions.AlexNet(num_classes=1)
+    elif model_name == 'resnet101':
+        return models.resnet101(num_classes=1)
+    elif model_name == 'resnet18':
+        return models.resnet18(num_classes=1)
+
+
+def train_epoch(model, train_loader, optimizer, criterion, training, mel_spectrogram=None):
+    # one pass over the training set, returns the sum of the batch losses
+    running_loss = 0
     for inputs, labels in train_loader:
-        steps += 1
         inputs, labels = inputs.to(device), labels.to(device)
+        if mel_spectrogram is not None:
+            inputs = train_loader.dataset.spectrogram_batch(mel_spectrogram(inputs))
+        inputs = training.inputs(inputs)
         optimizer.zero_grad()
-        logps = model(inputs)
+        with training.autocast():
+            logps = model(inputs)
+        # the loss in float32 whatever precision the model ran in
+        logps = logps.float()
         loss = criterion(logps.squeeze(1), labels.type_as(logps))
-        loss.backward()
-        optimizer.step()
+        training.step(loss, optimizer)
         running_loss += loss.item()
+    return running_loss
 
-    test_loss = 0
-    accuracy = 0
+
+def evaluate(model, test_loader, criterion, training, evaluator, mel_spectrogram=None):
+    evaluator.reset()
     model.eval()
     with torch.no_grad():
         for test_inputs, test_labels in test_loader:
             test_inputs, test_labels = test_inputs.to(device), test_labels.to(device)
-            test_logps = model.forward(test_inputs)
+            if mel_spectrogram is not None:
+                test_inputs = test_loader.dataset.spectrogram_batch(mel_spectrogram(test_inputs))
+            with training.autocast():
+                test_logps = model.forward(training.inputs(test_inputs))
+            test_logps = test_logps.float()
             batch_loss = criterion(test_logps.squeeze(1), test_labels.type_as(test_logps))
-            test_loss += batch_loss.item()
-
-            top_class = test_logps.gt(0.5)
-            equals = top_class == test_labels.view(*top_class.shape)
-            accuracy += torch.mean(equals.type(torch.FloatTensor)).item() * len(test_labels)
-
-    train_losses.append(running_loss / len(train_loader.dataset))
-    test_losses.append(test_loss / len(test_loader.dataset))
-    accuracies.append(accuracy / len(test_loader.dataset))
-    print(f"Epoch {epoch + 1}/{epochs}.. "
-          f"Train loss: {running_loss / len(train_loader.dataset):.3f}.. "
-          f"Test loss: {test_loss / len(test_loader.dataset):.3f}.. "
-          f"Test accuracy: {accuracy / len(test_loader.dataset):.3f}")
-    running_loss = 0
-    train_loader.dataset.shuffle()
+            # a bird is predicted when the sigmoid of the logit is over 0.5
+            evaluator.update(test_logps, test_labels, batch_loss)
     model.train()
-
-    save_path = f'models/{metadata_file}/birdcalls_{model_name}_{epoch + 1}.pth'
-    metadata[epoch + 1] = {
-        'running_loss': running_loss / len(train_loader.dataset),
-        'test_loss': test_loss / len(test_loader.dataset),
-        'accuracy': accuracy / len(test_loader.dataset)
-    }
-
-    if epoch == 0:
-        metadata[epoch + 1]['path'] = save_path
-        torch.save(model, save_path)
-    elif epoch % save_every == 1:
-        metadata[epoch + 1]['path'] = save_path
-        torch.save(model, save_path)
-    elif accuracy / len(test_loader.dataset) > max(accuracies):
-        metadata[epoch + 1]['path'] = save_path
-        torch.save(model, save_path)
-
-
-with open(f'models/{metadata_file}/metadata{model_name}.json', 'w') as outfile:
-    json.dump(metadata, outfile)
-
-plt.plot(range(epochs), train_losses, label='Train Losses')
-plt.plot(range(epochs), test_losses,  label='Test Losses')
-plt.plot(range(epochs), accuracies,  label='Test Accuracy')
-plt.legend()
+    return evaluator.compute()
+
+
+# the DataLoader workers re-import this module when processes are spawned
+if __name__ == '__main__':
+    model = create_model(model_name)
+
+    transformations = transforms.transforms.Compose([
+        transforms.transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                        std=[0.229, 0.224, 0.225])
+    ])
+
+    train_loader = data_loading.create_data_loader(
+        helper_functions.BirdCalls(Path('../bird_sounds/' + metadata_file), False,
+                                   x_size=224, y_size=224,
+                                   transformations=transformations,
+                                   raw_audio=frontend == 'torch'),
+        batch_size=16,
+        shuffle=True,
+        device=device,
+        loader_config=loader_config)
+
+    test_loader = data_loading.create_data_loader(
+        helper_functions.BirdCalls(Path('../bird_sounds/' + metadata_file), True,
+                                   x_size=224, y_size=224,
+                                   transformations=transformations,
+                                   raw_audio=frontend == 'torch'),
+        batch_size=50,
+        device=device,
+        loader_config=loader_config)
+
+    mel_spectrogram = None
+    if frontend == 'torch':
+        mel_spectrogram = train_loader.dataset.mel_frontend().to(device)
+    elif precompute_spectrograms:
+        for loader in [train_loader, test_loader]:
+            spectrogram_cache.precompute_spectrograms(loader.dataset.load_spectrogram, range(len(loader.dataset)), loader_config)
+
+    training = TrainingPrecision(precision, device)
+    model = training.model(model.to(device))
+    optimizer = optim.SGD(model.parameters(), lr=0.0005, momentum=0.9)
+    criterion = nn.BCEWithLogitsLoss()
+    evaluator = Evaluator()
+
+    if compare_precision:
+        inputs, labels = next(iter(train_loader))
+        inputs = inputs.to(device)
+        if mel_spectrogram is not None:
+            inputs = train_loader.dataset.spectrogram_batch(mel_spectrogram(inputs))
+        report_precision(model, lambda logps, labels: criterion(logps.squeeze(1), labels.type_as(logps)), inputs, labels,
+                         precision, device)
+
+    epochs = 40
+    save_every = 5
+    train_losses = []
+    test_losses = []
+    accuracies = []
+    metadata = {}
+
+    for epoch in range(epochs):
+        running_loss = train_epoch(model, train_loader, optimizer, criterion, training, mel_spectrogram)
+        test_metrics = evaluate(model, test_loader, criterion, training, evaluator, mel_spectrogram)
+
+        # the train loss is a sum of batch means, the test metrics are already averaged over samples
+        accuracy = test_metrics['hit_rate']
+        improved = not accuracies or accuracy > max(accuracies)
+
+        train_losses.append(running_loss / len(train_loader))
+        test_losses.append(test_metrics['loss'])
+        accuracies.append(accuracy)
+        print(f"Epoch {epoch + 1}/{epochs}.. "
+              f"Train loss: {running_loss / len(train_loader):.3f}.. "
+              f"Test loss: {test_metrics['loss']:.3f}.. "
+              f"Test accuracy: {accuracy:.3f}.. "
+              f"Calibration error: {test_metrics['calibration_error']:.3f}")
+
+        save_path = f'models/{metadata_file}/birdcalls_{model_name}_{epoch + 1}.pth'
+        metadata[epoch + 1] = {
+            'running_loss': running_loss / len(train_loader),
+            'test_loss': test_metrics['loss'],
+            'accuracy': accuracy,
+            'calibration_error': test_metrics['calibration_error']
+        }
+
+        if epoch == 0 or epoch % save_every == 1 or improved:
+            metadata[epoch + 1]['path'] = save_path
+            torch.save(model, save_path)
+
+    with open(f'models/{metadata_file}/metadata{model_name}.json', 'w') as outfile:
+        json.dump(metadata, outfile)
+
+    plt.plot(range(epochs), train_losses, label='Train Losses')
+    plt.plot(range(epochs), test_losses,  label='Test Losses')
+    plt.plot(range(epochs), accuracies,  label='Test Accuracy')
+    plt.legend()
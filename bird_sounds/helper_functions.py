@@ -9,6 +9,10 @@ from sklearn.utils import resample
 from torchvision import transforms
 import torch.nn.functional as F
 
+from common.audio_cache import AudioCache
+from common.spectrogram_cache import SpectrogramCache
+from common.mel_frontend import MelSpectrogram, frame_window
+
 
 def load_metadata(path: Path):
     metadata = pd.read_csv(path)
@@ -17,9 +21,9 @@ def load_metadata(path: Path):
     return metadata
 
 
-def load_sound_file(path):
+def load_sound_file(path, sr=22050, offset=0.0, duration=None):
     try:
-        data, rate = librosa.load(path)
+        data, rate = librosa.load(path, sr=sr, offset=offset, duration=duration)
 
     except Exception as e:
         print(f"Reading of sample {path.name} failed")
@@ -28,16 +32,16 @@ def load_sound_file(path):
     return data, rate
 
 
-def spectrogram_creation(audio, sample_rate, n_mels):
-    n_fft = 2048
-    hop_length = 512
-
-    spectrogram = librosa.feature.melspectrogram(audio, sr=sample_rate, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels)
+def spectrogram_creation(audio, sample_rate, n_mels, n_fft=2048, hop_length=512, window='hann'):
+    # reflect padded at the ends like the frame_window crops of the torch frontend
+    spectrogram = librosa.feature.melspectrogram(y=audio, sr=sample_rate, n_fft=n_fft, hop_length=hop_length, window=window,
+                                                 n_mels=n_mels, pad_mode='reflect')
     return spectrogram
 
 
 class BirdCalls(torch.utils.data.Dataset):
-    def __init__(self, metadata_path, test, x_size, y_size, transformations, split_percentage=0.8, seed=1994):
+    def __init__(self, metadata_path, test, x_size, y_size, transformations, split_percentage=0.8, seed=1994, audio_cache=None,
+                 spectrogram_cache=None, raw_audio=False):
         super(BirdCalls).__init__()
         metadata = load_metadata(metadata_path)
         rand.seed(seed)
@@ -50,12 +54,14 @@ class BirdCalls(torch.utils.data.Dataset):
         self.start = 0
         self.end = self.metadata.shape[0]
         self.classes = max(metadata.iloc[:, 1])
-        self.sound_files = {}
-        self.n = 0
-        self.print_n = 0
+        self.audio_cache = audio_cache or AudioCache()
+        self.spectrogram_cache = spectrogram_cache or SpectrogramCache()
+        self.spectrogram_settings = {'n_fft': 2048, 'hop_length': 512, 'window': 'hann', 'n_mels': x_size}
         self.x_size = x_size
         self.y_size = y_size
         self.transformations = transformations
+        # samples are waveforms and spectrogram_batch makes the spectrograms after collation
+        self.raw_audio = raw_audio
 
     def shuffle(self):
         self.metadata = self.metadata.sample(frac=1).reset_index(drop=True)
@@ -77,25 +83,29 @@ class BirdCalls(torch.utils.data.Dataset):
         return df_upsampled
 
     def load_sound_file(self, itemid):
-        if itemid not in self.sound_files:
-            if self.print_n % 100 == 0:
-                print(itemid)
-            self.print_n += 1
-            self.sound_files[itemid] = load_sound_file(itemid)
-        return self.sound_files[itemid]
+        # decoded once per file and shared on disk across workers and runs
+        return self.audio_cache.load(itemid, 22050, load_sound_file)
+
+    def create_spectrogram(self, itemid):
+        data, rate = self.load_sound_file(itemid)
+        return spectrogram_creation(data, rate, **self.spectrogram_settings)
 
     def load_spectrogram(self, index):
-        data, rate = self.load_sound_file(self.metadata.iloc[index, 2])
-        frequency_graph = spectrogram_creation(data, rate, self.x_size)
-        return frequency_graph
+        # computed on first use, later epochs read the memory mapped spectrogram without decoding or an stft
+        itemid = self.metadata.iloc[index, 2]
+        return self.spectrogram_cache.load(itemid, 22050, lambda: self.create_spectrogram(itemid), **self.spectrogram_settings)
 
     def get_one_hot(self, target):
         a = torch.zeros(self.classes + 1, dtype=torch.long)
         a[target] = 1
         return a
 
+    def crop_start(self, frames):
+        # the first frame of a random y_size crop of a recording with frames frames
+        return rand.randint(0, max(frames - self.y_size, 0))
+
     def subsample(self, sample):
-        start = rand.randint(0, len(sample) - self.y_size)
+        start = self.crop_start(sample.shape[1])
         sample = sample[:, start:(start + self.y_size)]
         return sample
 
@@ -108,9 +118,30 @@ class BirdCalls(torch.utils.data.Dataset):
 
         return F.pad(input=sample, pad=padding_dimension, mode='constant', value=0)
 
+    def load_waveform(self, index):
+        # the audio of a random y_size frame window
+        data, _ = self.load_sound_file(self.metadata.iloc[index, 2])
+        hop_length = self.spectrogram_settings['hop_length']
+        start = self.crop_start(len(data) // hop_length + 1)
+        sample = frame_window(data, start, self.y_size, self.spectrogram_settings['n_fft'], hop_length)
+        return torch.from_numpy(sample).float(), self.metadata.iloc[index, 1]
+
+    def mel_frontend(self):
+        # the torch frontend for the load_waveform windows
+        return MelSpectrogram(22050, center=False, **self.spectrogram_settings)
+
+    def spectrogram_batch(self, spectrograms: torch.Tensor):
+        # batch x x_size x y_size from mel_frontend into the batches load_sample makes, the windows are exactly
+        # y_size frames so there is nothing to pad
+        sample = spectrograms.unsqueeze(1).repeat(1, 3, 1, 1)
+        return self.transformations(sample)
+
     def load_sample(self, index):
+        if self.raw_audio:
+            return self.load_waveform(index)
         sample = self.load_spectrogram(index)
-        sample = self.subsample(sample)
+        # copies the crop out of the read only memory map
+        sample = np.array(self.subsample(sample))
         sample = transforms.transforms.ToTensor()(sample)
         sample = sample.repeat(3, 1, 1)
         sample = self.transformations(sample)
@@ -118,14 +149,6 @@ class BirdCalls(torch.utils.data.Dataset):
         label = self.metadata.iloc[index, 1]
         return sample, label
 
-    def __next__(self):
-        if self.n <= self.end:
-            sample, label = self.load_sample(self.n)
-            self.n += 1
-            return sample, label
-        else:
-            raise StopIteration
-
     def __getitem__(self, index):
         sample, label = self.load_sample(index)
         return sample, label
@@ -0,0 +1,69 @@
+import time
+import torch
+from torch import nn
+
+import bookingdotcom.helper_functions as helper_functions
+
+# Compares LinearNN running the fc tower five times against one stacked call
+city_numbers = 67566
+batch_size = 256
+repeats = 10
+device = 'cpu'
+cities_per_input = 10
+
+torch.manual_seed(1994)
+
+
+def random_input():
+    # mostly zero rows, like the trip and node feature vectors
+    x = torch.zeros(batch_size, 1, city_numbers)
+    x.scatter_(2, torch.randint(city_numbers, (batch_size, 1, cities_per_input)), torch.rand(batch_size, 1, cities_per_input))
+    return x.to(device)
+
+
+def time_model(model, inputs, target, training):
+    criterion = nn.BCEWithLogitsLoss()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.05, momentum=0.9)
+    timings = []
+    for _ in range(repeats + 1):
+        start = time.perf_counter()
+        if training:
+            optimizer.zero_grad()
+            loss = criterion(model(*inputs).squeeze(1), target)
+            loss.backward()
+            optimizer.step()
+        else:
+            with torch.no_grad():
+                model(*inputs)
+        timings.append(time.perf_counter() - start)
+
+    # first run is warm up
+    return sorted(timings[1:])[len(timings[1:]) // 2]
+
+
+separate = helper_functions.LinearNN(city_numbers=city_numbers)
+fused = helper_functions.LinearNN(city_numbers=city_numbers, fuse_inputs=True)
+fused.load_state_dict(separate.state_dict())
+separate.to(device)
+fused.to(device)
+
+inputs = [random_input() for _ in range(5)]
+target = torch.zeros(batch_size, city_numbers, device=device)
+target[torch.arange(batch_size), torch.randint(city_numbers, (batch_size,))] = 1
+
+separate.eval()
+fused.eval()
+with torch.no_grad():
+    difference = (separate(*inputs) - fused(*inputs)).abs().max().item()
+print(f"Maximum difference between the outputs: {difference:.2e}")
+
+for training in [False, True]:
+    for model in [separate, fused]:
+        model.train(training)
+
+    separate_time = time_model(separate, inputs, target, training)
+    fused_time = time_model(fused, inputs, target, training)
+    print(f"{'Training step' if training else 'Inference'}.. "
+          f"separate: {separate_time * 1000:.1f}ms.. "
+          f"fused: {fused_time * 1000:.1f}ms.. "
+          f"speed up: {separate_time / fused_time:.2f}x")
@@ -1,10 +1,12 @@
 from pathlib import Path
+import numpy as np
 import torch
 from torch import optim
 import json
-from torch import nn
+import torch.nn.functional as F
 
 import bookingdotcom.helper_functions as helper_functions
+from common.evaluation import Evaluator
 
 cache_location = Path('bookingdotcom/cache/')
 epochs = 1000
@@ -13,127 +15,158 @@ device = 'cuda'
 device = 'cpu'
 model_location = Path('models/bookingdotcom/')
 config_file = model_location / 'metadata.json'
-
-connected_node_features = torch.load(cache_location / 'connected_node_features.pkl')
-trips = torch.load(cache_location / 'trip_properties.pkl')
-
-
-train_loader = torch.utils.data.DataLoader(
-    helper_functions.BookingLoader(trips=trips.copy(),
-                                   connected_node_features=connected_node_features.copy(),
-                                   training=True,
-                                   number_of_classes=67566,
-                                   training_percentage=0.8),
-    batch_size=256)
-
-test_loader = torch.utils.data.DataLoader(
-    helper_functions.BookingLoader(trips=trips.copy(),
-                                   connected_node_features=connected_node_features.copy(),
-                                   training=False,
-                                   number_of_classes=67566,
-                                   training_percentage=0.8),
-    batch_size=256)
-
-
-if config_file.exists():
-    with open(config_file, 'r') as outfile:
-        metadata = json.load(outfile)
-
-    for key, value in metadata.items():
-        if 'path' in value:
-            model_path = value['path']
-            starting_iteration = int(key)
-
-    model = torch.load(model_path)
-
-else:
-    model = helper_functions.LinearNN(city_numbers=67566)
-    metadata = {}
-    starting_iteration = 0
-
-
-optimizer = optim.SGD(model.parameters(), lr=0.05, momentum=0.9)
-criterion = nn.BCEWithLogitsLoss()
-model.to(device)
-
-steps = 0
-running_loss = 0
-train_losses = []
-test_losses = []
-accuracies = []
-metadata = {}
-
-for epoch in range(epochs):
-    for final_city, trip_cities, previous_cities, node_features, trip_id in train_loader:
-        steps += 1
-
-        trip_cities = trip_cities.to_dense().to(device)
-        previous_cities = previous_cities.to_dense().to(device)
-        closeness = node_features.to_dense()[:, 0:1, ].to(device)
-        betweenness = node_features.to_dense()[:, 1:2, ].to(device)
-        triangles = node_features.to_dense()[:, 2:, ].to(device)
+# feed the first layer the non-zero cities only instead of dense 67566 wide vectors
+sparse_input = False
+# run the shared fc tower once over all five inputs stacked along the batch
+fuse_inputs = True
+# integer final city targets trained with a sampled softmax, False trains BCE against one hot vectors of every city
+index_targets = False
+sampled_cities = 8192
+# DataLoader workers, pinned memory and prefetching, see common.data_loading
+loader_config = {'num_workers': None, 'pin_memory': None, 'persistent_workers': True, 'prefetch_factor': 2}
+
+
+def train_epoch(model, train_loader, optimizer, final_city_frequency):
+    # one pass over the training trips, returns the sum of the batch losses
+    running_loss = 0
+    for final_city, trip_cities, previous_cities, node_features, current_city, trip_id in train_loader:
+        trip_cities = trip_cities.to(device)
+        previous_cities = previous_cities.to(device)
+        closeness, betweenness, triangles = helper_functions.split_node_features(node_features, device)
         final_city = final_city.to(device)
 
         optimizer.zero_grad()
-        logps = model(closeness, betweenness, triangles, trip_cities, previous_cities)
-        # times by the cities which previously have been visited by the latest city
-        valid_cities = (closeness > 0).float()
-        logps = logps * valid_cities
-
-        loss = criterion(logps.squeeze(1), final_city.type_as(logps))
+        # only the cities which previously have been visited from the latest city
+        valid_cities = helper_functions.valid_cities(closeness)
+        if index_targets:
+            hidden = model.hidden(closeness, betweenness, triangles, trip_cities, previous_cities)
+            loss = helper_functions.sampled_softmax_loss(model.classifier[-1], hidden, final_city, sampled_cities,
+                                                         final_city_frequency, valid_cities)
+        else:
+            logps = model(closeness, betweenness, triangles, trip_cities, previous_cities)
+            # a -inf logit makes BCE nan, so the other cities are left out of the loss by weight instead
+            loss = F.binary_cross_entropy_with_logits(logps.squeeze(1), final_city.type_as(logps),
+                                                      weight=valid_cities.squeeze(1).type_as(logps))
         loss.backward()
         optimizer.step()
         running_loss += loss.item()
+    return running_loss
+
 
-    test_loss = 0
-    accuracy = 0
+def evaluate(model, test_loader, evaluator):
+    evaluator.reset()
     model.eval()
     with torch.no_grad():
-        for test_final_city, test_trip_cities, test_previous_cities, test_node_features, trip_id in test_loader:
-            test_trip_cities = test_trip_cities.to_dense().to(device)
-            test_previous_cities = test_previous_cities.to_dense().to(device)
-            closeness = test_node_features.to_dense()[:, 0:1, ].to(device)
-            betweenness = test_node_features.to_dense()[:, 1:2, ].to(device)
-            triangles = test_node_features.to_dense()[:, 2:, ].to(device)
+        for test_final_city, test_trip_cities, test_previous_cities, test_node_features, test_current_city, trip_id in test_loader:
+            test_trip_cities = test_trip_cities.to(device)
+            test_previous_cities = test_previous_cities.to(device)
+            closeness, betweenness, triangles = helper_functions.split_node_features(test_node_features, device)
             test_final_city = test_final_city.to(device)
 
-            test_logps = model(closeness, betweenness, triangles, test_trip_cities, test_previous_cities)
-
-            valid_cities = (closeness > 0).float()
-            test_logps = test_logps * valid_cities
-
-            predictions = []
-            for final_city_, maximum_cities in zip(test_final_city.topk(1)[1], test_logps.topk(4)[1]):
-                predictions.append(final_city_ in maximum_cities)
-
-            accuracy += sum(predictions) / len(test_final_city)
-
-    train_losses.append(running_loss / len(train_loader.dataset))
-    test_losses.append(test_loss / len(test_loader.dataset))
-    accuracies.append(accuracy)
-    print(f"Epoch {epoch + 1}/{epochs}.. "
-          f"Train loss: {running_loss / len(train_loader.dataset):.3f}.. "
-          f"Test accuracy: {accuracy:.3f}")
-    running_loss = 0
+            test_logps = model(closeness, betweenness, triangles, test_trip_cities, test_previous_cities).squeeze(1)
+            valid_cities = helper_functions.valid_cities(closeness).squeeze(1)
+            # the cities which aren't connected to the current city rank last
+            masked_logps = test_logps.masked_fill(~valid_cities, -float('inf'))
+
+            if index_targets:
+                # the final city stays in the softmax when it isn't connected, so one trip can't make the loss inf
+                kept = valid_cities.scatter(1, test_final_city.unsqueeze(1), True)
+                batch_loss = F.cross_entropy(test_logps.masked_fill(~kept, -float('inf')), test_final_city)
+            else:
+                batch_loss = F.binary_cross_entropy_with_logits(test_logps, test_final_city.type_as(test_logps),
+                                                                weight=valid_cities.type_as(test_logps))
+            evaluator.update(masked_logps, test_final_city, batch_loss)
     model.train()
+    return evaluator.compute()
+
+
+# the DataLoader workers re-import this module when processes are spawned
+if __name__ == '__main__':
+    connected_node_features = helper_functions.load_feature_store(cache_location / 'connected_node_features')
+    trips = helper_functions.load_feature_store(cache_location / 'trip_properties')
+
+    train_loader = helper_functions.create_batch_loader(
+        helper_functions.BookingLoader(trips=trips,
+                                       connected_node_features=connected_node_features,
+                                       training=True,
+                                       number_of_classes=67566,
+                                       training_percentage=0.8,
+                                       sparse_input=sparse_input,
+                                       index_targets=index_targets),
+        batch_size=256,
+        device=device,
+        loader_config=loader_config)
+
+    test_loader = helper_functions.create_batch_loader(
+        helper_functions.BookingLoader(trips=trips,
+                                       connected_node_features=connected_node_features,
+                                       training=False,
+                                       number_of_classes=67566,
+                                       training_percentage=0.8,
+                                       sparse_input=sparse_input,
+                                       index_targets=index_targets),
+        batch_size=256,
+        device=device,
+        loader_config=loader_config)
+
+    if config_file.exists():
+        with open(config_file, 'r') as outfile:
+            metadata = json.load(outfile)
+
+        for key, value in metadata.items():
+            if 'path' in value:
+                model_path = value['path']
+                starting_iteration = int(key)
+
+        model = torch.load(model_path)
+        model.fuse_inputs = fuse_inputs
+
+    else:
+        model = helper_functions.LinearNN(city_numbers=67566, sparse_input=sparse_input, fuse_inputs=fuse_inputs)
+        metadata = {}
+        starting_iteration = 0
+
+    optimizer = optim.SGD(model.parameters(), lr=0.05, momentum=0.9)
+    # share of the training trips each city ends, for the sampled softmax correction
+    final_cities = trips['final_city'][train_loader.dataset.indices]
+    final_city_frequency = torch.from_numpy(np.bincount(final_cities, minlength=67566) / len(final_cities)).float().to(device)
+    evaluator = Evaluator(k=4)
+    model.to(device)
+
+    train_losses = []
+    test_losses = []
+    accuracies = []
+    metadata = {}
 
-    save_path = model_location / f'booking_model_{epoch + 1}.pth'
-    metadata[epoch + 1] = {
-        'running_loss': running_loss / len(train_loader.dataset),
-        'accuracy': accuracy / len(test_loader.dataset)
-    }
-
-    if epoch == 0:
-        model_location.mkdir(parents=True, exist_ok=True)
-        metadata[epoch + 1]['path'] = str(save_path)
-        torch.save(model, save_path)
-    elif epoch % save_every == 1:
-        metadata[epoch + 1]['path'] = str(save_path)
-        torch.save(model, save_path)
-    elif accuracy / len(test_loader.dataset) > max(accuracies):
-        metadata[epoch + 1]['path'] = str(save_path)
-        torch.save(model, save_path)
-
-
-with open(config_file, 'w') as outfile:
-    json.dump(metadata, outfile)
+    for epoch in range(epochs):
+        running_loss = train_epoch(model, train_loader, optimizer, final_city_frequency)
+        test_metrics = evaluate(model, test_loader, evaluator)
+
+        # the train loss is a sum of batch means, the test metrics are already averaged over trips
+        accuracy = test_metrics['hit_rate']
+        improved = not accuracies or accuracy > max(accuracies)
+
+        train_losses.append(running_loss / len(train_loader))
+        test_losses.append(test_metrics['loss'])
+        accuracies.append(accuracy)
+        print(f"Epoch {epoch + 1}/{epochs}.. "
+              f"Train loss: {running_loss / len(train_loader):.3f}.. "
+              f"Test loss: {test_metrics['loss']:.3f}.. "
+              f"Test accuracy: {accuracy:.3f}.. "
+              f"Calibration error: {test_metrics['calibration_error']:.3f}")
+
+        save_path = model_location / f'booking_model_{epoch + 1}.pth'
+        metadata[epoch + 1] = {
+            'running_loss': running_loss / len(train_loader),
+            'test_loss': test_metrics['loss'],
+            'accuracy': accuracy,
+            'calibration_error': test_metrics['calibration_error']
+        }
+
+        if epoch == 0 or epoch % save_every == 1 or improved:
+            model_location.mkdir(parents=True, exist_ok=True)
+            metadata[epoch + 1]['path'] = str(save_path)
+            torch.save(model, save_path)
+
+    with open(config_file, 'w') as outfile:
+        json.dump(metadata, outfile)
@@ -0,0 +1,215 @@
+import heapq
+import math
+import os
+import random as rand
+from collections import deque
+from itertools import count
+from multiprocessing import Pool
+
+import networkx as nx
+
+# graph shared with the pool workers, set once per worker by the pool initializer
+_graph = None
+
+
+def _set_graph(graph: nx.Graph):
+    global _graph
+    _graph = graph
+
+
+def shortest_paths(graph: nx.Graph, source, weight=None):
+    # single source search from Brandes' algorithm, returns the nodes in visiting order,
+    # their predecessors on shortest paths, the number of shortest paths and the distances
+    if weight is None:
+        return _breadth_first_paths(graph, source)
+    return _dijkstra_paths(graph, source, weight)
+
+
+def _breadth_first_paths(graph: nx.Graph, source):
+    order = []
+    predecessors = {source: []}
+    sigma = {source: 1}
+    distance = {source: 0}
+
+    queue = deque([source])
+    while queue:
+        v = queue.popleft()
+        order.append(v)
+        for w in graph[v]:
+            if w not in distance:
+                distance[w] = distance[v] + 1
+                sigma[w] = 0
+                predecessors[w] = []
+                queue.append(w)
+            if distance[w] == distance[v] + 1:
+                sigma[w] += sigma[v]
+                predecessors[w].append(v)
+
+    return order, predecessors, sigma, distance
+
+
+def _dijkstra_paths(graph: nx.Graph, source, weight):
+    order = []
+    predecessors = {source: []}
+    sigma = {source: 1}
+    distance = {}
+
+    # a missing edge attribute counts as 1, as in networkx
+    seen = {source: 0}
+    counter = count()
+    heap = [(0, next(counter), source)]
+    while heap:
+        dist, _, v = heapq.heappop(heap)
+        if v in distance:
+            continue
+        distance[v] = dist
+        order.append(v)
+        for w, edge in graph[v].items():
+            vw_dist = dist + edge.get(weight, 1)
+            if w in distance:
+                continue
+            if w not in seen or vw_dist < seen[w]:
+                seen[w] = vw_dist
+                sigma[w] = sigma[v]
+                predecessors[w] = [v]
+                heapq.heappush(heap, (vw_dist, next(counter), w))
+            elif vw_dist == seen[w]:
+                sigma[w] += sigma[v]
+                predecessors[w].append(v)
+
+    return order, predecessors, sigma, distance
+
+
+def _betweenness_chunk(arguments):
+    sources, weight = arguments
+    betweenness = {}
+    for source in sources:
+        order, predecessors, sigma, _ = shortest_paths(_graph, source, weight)
+        delta = dict.fromkeys(order, 0)
+        for w in reversed(order):
+            for v in predecessors[w]:
+                delta[v] += sigma[v] / sigma[w] * (1 + delta[w])
+            if w != source:
+                betweenness[w] = betweenness.get(w, 0) + delta[w]
+
+    return betweenness
+
+
+def _closeness_chunk(arguments):
+    nodes, distance = arguments
+    number_of_nodes = len(_graph)
+    closeness = {}
+    for node in nodes:
+        _, _, _, lengths = shortest_paths(_graph, node, distance)
+        closeness[node] = _closeness(sum(lengths.values()), len(lengths), number_of_nodes)
+
+    return closeness
+
+
+def _pivot_chunk(arguments):
+    pivots, distance = arguments
+    totals = {}
+    counts = {}
+    for pivot in pivots:
+        _, _, _, lengths = shortest_paths(_graph, pivot, distance)
+        for node, length in lengths.items():
+            if node != pivot:
+                totals[node] = totals.get(node, 0) + length
+                counts[node] = counts.get(node, 0) + 1
+
+    return totals, counts
+
+
+def _closeness(total_distance, reachable, number_of_nodes):
+    # networkx closeness with wf_improved, scaled by the share of the graph which is reachable
+    if total_distance <= 0 or number_of_nodes <= 1:
+        return 0.0
+    return (reachable - 1) / total_distance * (reachable - 1) / (number_of_nodes - 1)
+
+
+def _run_chunks(graph: nx.Graph, function, items: list, argument, processes=None):
+    processes = processes or os.cpu_count()
+    chunk_size = max(1, math.ceil(len(items) / (processes * 4)))
+    chunks = [(items[x:x + chunk_size], argument) for x in range(0, len(items), chunk_size)]
+
+    if processes == 1 or len(chunks) <= 1:
+        _set_graph(graph)
+        return [function(chunk) for chunk in chunks]
+
+    with Pool(processes, initializer=_set_graph, initargs=(graph,)) as pool:
+        return pool.map(function, chunks)
+
+
+def betweenness_centrality(graph: nx.Graph, k=None, weight=None, processes=None, seed=None):
+    # same values as nx.betweenness_centrality(normalized=True), with the k sampled
+    # sources split across a process pool and the partial sums merged
+    nodes = list(graph)
+    number_of_nodes = len(nodes)
+    if k == number_of_nodes:
+        k = None
+    sources = nodes if k is None else rand.Random(seed).sample(nodes, k)
+
+    betweenness = dict.fromkeys(nodes, 0.0)
+    for partial in _run_chunks(graph, _betweenness_chunk, sources, weight, processes):
+        for node, value in partial.items():
+            betweenness[node] += value
+
+    if number_of_nodes <= 2:
+        return betweenness
+
+    # a sampled source is never counted as its own endpoint so, like networkx, it is
+    # averaged over the other k - 1 sources and every other node over all k of them
+    if k is None:
+        source_scale = other_scale = 1 / ((number_of_nodes - 1) * (number_of_nodes - 2))
+    else:
+        source_scale = 1 / ((k - 1) * (number_of_nodes - 2)) if k > 1 else math.nan
+        other_scale = 1 / (k * (number_of_nodes - 2))
+    sources = set(sources)
+    return {node: value * (source_scale if node in sources else other_scale) for node, value in betweenness.items()}
+
+
+def closeness_centrality(graph: nx.Graph, distance=None, epsilon=None, processes=None, seed=None):
+    # exact when epsilon is None, otherwise the pivot estimator of Eppstein and Wang: the mean distance to
+    # log(n) / epsilon ** 2 random pivots is within epsilon times the graph diameter of the true mean
+    # distance with high probability
+    nodes = list(graph)
+    number_of_pivots = len(nodes)
+    if epsilon is not None and len(nodes) > 1:
+        number_of_pivots = math.ceil(math.log(len(nodes)) / epsilon ** 2)
+
+    closeness = {}
+    exact_nodes = nodes
+    if number_of_pivots < len(nodes):
+        closeness, exact_nodes = _pivot_closeness(graph, rand.Random(seed).sample(nodes, number_of_pivots),
+                                                  distance, processes)
+
+    for partial in _run_chunks(graph, _closeness_chunk, exact_nodes, distance, processes):
+        closeness.update(partial)
+    return closeness
+
+
+def _pivot_closeness(graph: nx.Graph, pivots: list, distance, processes):
+    totals = dict.fromkeys(graph, 0)
+    counts = dict.fromkeys(graph, 0)
+    for partial_totals, partial_counts in _run_chunks(graph, _pivot_chunk, pivots, distance, processes):
+        for node, value in partial_totals.items():
+            totals[node] += value
+            counts[node] += partial_counts[node]
+
+    component_size = {}
+    for component in nx.connected_components(graph):
+        for node in component:
+            component_size[node] = len(component)
+
+    # components no bigger than the pivot sample are cheaper to compute exactly
+    closeness = {}
+    exact_nodes = []
+    for node in graph:
+        if counts[node] == 0 or component_size[node] <= len(pivots):
+            exact_nodes.append(node)
+            continue
+        # estimated total distance to the rest of the component
+        total_distance = totals[node] / counts[node] * (component_size[node] - 1)
+        closeness[node] = _closeness(total_distance, component_size[node], len(graph))
+
+    return closeness, exact_nodes
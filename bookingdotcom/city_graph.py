@@ -0,0 +1,175 @@
+import pickle as pkl
+from collections import deque
+from pathlib import Path
+
+import networkx as nx
+import numpy as np
+from scipy import sparse
+
+
+class CityGraph:
+    # undirected city graph as csr arrays, node ids are the city ids and rows are in city id order
+    def __init__(self, nodes, indptr, indices, weights, node_attributes=None):
+        self.nodes = np.asarray(nodes, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.weights = np.asarray(weights)
+        # name -> (values, present) with one entry per node
+        self.node_attributes = node_attributes or {}
+
+        self.positions = np.full(self.nodes.max() + 1 if len(self.nodes) else 0, -1, dtype=np.int64)
+        self.positions[self.nodes] = np.arange(len(self.nodes))
+        # row normalised adjacency for candidates, built on the first call
+        self._transition = None
+
+    @classmethod
+    def from_networkx(cls, graph: nx.Graph, weight='weight'):
+        nodes = np.array(sorted(graph.nodes()), dtype=np.int64)
+        positions = np.full(nodes.max() + 1 if len(nodes) else 0, -1, dtype=np.int64)
+        positions[nodes] = np.arange(len(nodes))
+
+        edges = list(graph.edges(data=weight, default=1))
+        city_a = positions[np.array([x[0] for x in edges], dtype=np.int64)]
+        city_b = positions[np.array([x[1] for x in edges], dtype=np.int64)]
+        edge_weights = np.array([x[2] for x in edges])
+
+        # both directions of every edge, self loops once
+        different = city_a != city_b
+        adjacency = sparse.csr_matrix((np.concatenate([edge_weights, edge_weights[different]]),
+                                       (np.concatenate([city_a, city_b[different]]),
+                                        np.concatenate([city_b, city_a[different]]))),
+                                      shape=(len(nodes), len(nodes)))
+        adjacency.sort_indices()
+
+        node_attributes = {}
+        names = {name for _, data in graph.nodes(data=True) for name in data}
+        for name in sorted(names):
+            present = np.array([name in graph.nodes[node] for node in nodes], dtype=bool)
+            values = [graph.nodes[node].get(name) for node in nodes]
+            fill = next(x for x in values if x is not None)
+            values = np.array([fill if x is None else x for x in values])
+            node_attributes[name] = (values, present)
+
+        return cls(nodes, adjacency.indptr, adjacency.indices, adjacency.data, node_attributes)
+
+    @classmethod
+    def from_gpickle(cls, path: Path, weight='weight'):
+        with open(path, 'rb') as file:
+            return cls.from_networkx(pkl.load(file), weight=weight)
+
+    def to_networkx(self, weight='weight'):
+        graph = nx.Graph(directed=False)
+        for position, node in enumerate(self.nodes.tolist()):
+            graph.add_node(node, **{name: values[position].item()
+                                    for name, (values, present) in self.node_attributes.items()
+                                    if present[position]})
+
+        rows = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+        upper = rows <= self.indices
+        graph.add_edges_from((city_a, city_b, {weight: edge_weight})
+                             for city_a, city_b, edge_weight in zip(self.nodes[rows[upper]].tolist(),
+                                                                    self.nodes[self.indices[upper]].tolist(),
+                                                                    self.weights[upper].tolist()))
+        return graph
+
+    def to_gpickle(self, path: Path):
+        # a pickled networkx graph, as create_networkx.py writes
+        with open(path, 'wb') as file:
+            pkl.dump(self.to_networkx(), file, pkl.HIGHEST_PROTOCOL)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def adjacency(self):
+        return sparse.csr_matrix((self.weights, self.indices, self.indptr), shape=(len(self.nodes), len(self.nodes)))
+
+    def transition(self):
+        if self._transition is None:
+            adjacency = self.adjacency().astype(np.float64)
+            self._transition = (sparse.diags(1 / np.maximum(np.asarray(adjacency.sum(axis=1)).ravel(), 1)) @ adjacency).tocsr()
+        return self._transition
+
+    def node_attribute(self, name):
+        values, _ = self.node_attributes[name]
+        return values
+
+    def neighbors(self, node):
+        # KeyError for a node that isn't in the graph, like graph[node] in networkx
+        if not 0 <= node < len(self.positions) or self.positions[node] < 0:
+            raise KeyError(node)
+        position = self.positions[node]
+        return self.nodes[self.indices[self.indptr[position]:self.indptr[position + 1]]]
+
+    def degree(self):
+        # self loops count twice, as in networkx
+        rows = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+        self_loops = np.bincount(rows[rows == self.indices], minlength=len(self.nodes))
+        return np.diff(self.indptr) + self_loops
+
+    def triangles(self):
+        # diagonal of A^3 / 2 on the unweighted adjacency without self loops
+        adjacency = self.adjacency().astype(bool).astype(np.int64)
+        adjacency.setdiag(0)
+        adjacency.eliminate_zeros()
+        paths = (adjacency @ adjacency).multiply(adjacency)
+        return np.asarray(paths.sum(axis=1)).ravel() // 2
+
+    def candidates(self, cities, number_of_candidates=300):
+        # neighbours ranked by how often trips move between the cities, topped up with the cities two steps
+        # away ranked by random walk probability. returns city ids and a mask of the filled slots, both
+        # len(cities) x number_of_candidates
+        cities = np.asarray(cities, dtype=np.int64)
+        positions = self.positions[np.clip(cities, 0, len(self.positions) - 1)]
+        known = np.flatnonzero((cities < len(self.positions)) & (positions >= 0))
+
+        transition = self.transition()
+        first_step = transition[positions[known]]
+        # only trips with too few neighbours need the second step
+        short = np.diff(first_step.indptr) < number_of_candidates
+        second_step = sparse.diags(short.astype(np.float64)) @ first_step @ transition
+        # every neighbour scores above 1 so they rank ahead of the second step cities
+        scores = (second_step + first_step + first_step.sign()).tocsr()
+        scores.eliminate_zeros()
+
+        rows = np.repeat(np.arange(scores.shape[0]), np.diff(scores.indptr))
+        order = np.lexsort((-scores.data, rows))
+        rank = np.arange(len(order)) - np.repeat(scores.indptr[:-1], np.diff(scores.indptr))
+        keep = rank < number_of_candidates
+
+        candidates = np.zeros((len(cities), number_of_candidates), dtype=np.int64)
+        filled = np.zeros((len(cities), number_of_candidates), dtype=bool)
+        candidates[known[rows[keep]], rank[keep]] = self.nodes[scores.indices[order][keep]]
+        filled[known[rows[keep]], rank[keep]] = True
+        return candidates, filled
+
+    def subgraph(self, nodes):
+        positions = np.sort(self.positions[np.asarray(nodes, dtype=np.int64)])
+        adjacency = self.adjacency()[positions][:, positions].tocsr()
+        adjacency.sort_indices()
+        node_attributes = {name: (values[positions], present[positions])
+                           for name, (values, present) in self.node_attributes.items()}
+
+        return CityGraph(self.nodes[positions], adjacency.indptr, adjacency.indices, adjacency.data, node_attributes)
+
+    def bfs_subgraph(self, starting_node, depth=4):
+        # same selection as helper_functions.random_subgraph: the nodes reached by breadth first search
+        # from the first depth - 1 nodes expanded
+        visited = np.zeros(len(self.nodes), dtype=bool)
+        start = self.positions[starting_node]
+        visited[start] = True
+        queue = deque([start])
+        expanded = 0
+        selecting_nodes = []
+
+        while queue and expanded < depth - 1:
+            position = queue.popleft()
+            neighbours = self.indices[self.indptr[position]:self.indptr[position + 1]]
+            neighbours = neighbours[~visited[neighbours]]
+            if len(neighbours) == 0:
+                continue
+            expanded += 1
+            visited[neighbours] = True
+            queue.extend(neighbours.tolist())
+            selecting_nodes += self.nodes[neighbours].tolist()
+
+        return self.subgraph(selecting_nodes)
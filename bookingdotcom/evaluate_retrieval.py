@@ -0,0 +1,69 @@
+import time
+from pathlib import Path
+import torch
+
+import bookingdotcom.helper_functions as helper_functions
+from bookingdotcom.city_graph import CityGraph
+
+# Top 4 accuracy and time of scoring every city against scoring the retrieved candidates only, on the held out trips
+cache_location = Path('bookingdotcom/cache/')
+model_path = Path('models/bookingdotcom/booking_model_11.pth')
+device = 'cpu'
+batch_size = 1000
+number_of_candidates = 300
+
+connected_node_features = helper_functions.load_feature_store(cache_location / 'connected_node_features')
+trips = helper_functions.load_feature_store(cache_location / 'trip_properties')
+city_graph = CityGraph.from_gpickle(cache_location / 'network_graph.pkl')
+
+model = torch.load(model_path, map_location=device)
+model.eval()
+model.fuse_inputs = True
+sparse_input = isinstance(model.fc[0], helper_functions.SparseLinear)
+
+test_loader = helper_functions.create_batch_loader(
+    helper_functions.BookingLoader(trips=trips,
+                                   connected_node_features=connected_node_features,
+                                   training=False,
+                                   number_of_classes=67566,
+                                   training_percentage=0.8,
+                                   sparse_input=sparse_input),
+    batch_size=batch_size)
+
+full_hits = 0
+candidate_hits = 0
+recalled = 0
+full_time = 0
+candidate_time = 0
+number_of_trips = 0
+with torch.no_grad():
+    for final_city, trip_cities, previous_cities, node_features, current_city, trip_id in test_loader:
+        trip_cities = trip_cities.to(device)
+        previous_cities = previous_cities.to(device)
+        closeness, betweenness, triangles = helper_functions.split_node_features(node_features, device)
+        final_city = final_city.argmax(-1).to(device)
+
+        start = time.perf_counter()
+        full_cities = helper_functions.top_cities(model, closeness, betweenness, triangles,
+                                                  trip_cities, previous_cities, k=4).view(len(trip_id), -1)
+        full_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        candidates, filled = city_graph.candidates(current_city.numpy(), number_of_candidates)
+        candidates = torch.from_numpy(candidates).to(device)
+        filled = torch.from_numpy(filled).to(device)
+        candidate_cities = helper_functions.top_candidate_cities(model, closeness, betweenness, triangles,
+                                                                 trip_cities, previous_cities, candidates, filled, k=4)
+        candidate_time += time.perf_counter() - start
+
+        full_hits += (full_cities == final_city.unsqueeze(-1)).any(-1).sum().item()
+        candidate_hits += (candidate_cities == final_city.unsqueeze(-1)).any(-1).sum().item()
+        recalled += ((candidates == final_city.unsqueeze(-1)) & filled).any(-1).sum().item()
+        number_of_trips += len(trip_id)
+
+print(f"Trips: {number_of_trips}.. candidates per trip: {number_of_candidates}")
+print(f"All cities.. top 4 accuracy: {full_hits / number_of_trips:.4f}.. "
+      f"time per trip: {full_time / number_of_trips * 1000:.3f}ms")
+print(f"Candidates.. top 4 accuracy: {candidate_hits / number_of_trips:.4f}.. "
+      f"time per trip: {candidate_time / number_of_trips * 1000:.3f}ms.. "
+      f"final city recalled: {recalled / number_of_trips:.4f}")
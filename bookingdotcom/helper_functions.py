@@ -1,8 +1,20 @@
+import json
+import math
+import shutil
+from pathlib import Path
 import networkx as nx
 import torch
 import numpy as np
+import pandas as pd
+from scipy import sparse
 import random as rand
 import torch.nn as nn
+import torch.nn.functional as F
+
+import common.data_loading as data_loading
+from bookingdotcom.user_history import UserHistory
+
+FEATURE_STORE_VERSION = 2
 
 
 def random_subgraph(graph: nx.Graph, depth=4, starting_node=2):
@@ -20,6 +32,86 @@ def random_subgraph(graph: nx.Graph, depth=4, starting_node=2):
     return k
 
 
+def city_nodes(training_data: pd.DataFrame):
+    return training_data.groupby(['city_id', 'hotel_country']).agg({'utrip_id': 'count'}).reset_index()
+
+
+def city_edge_counts(training_data: pd.DataFrame):
+    # consecutive cities within a trip, as an undirected (smaller, larger) pair
+    previous_city = training_data.groupby('utrip_id', sort=False)['city_id'].shift()
+    connected = previous_city.notna().to_numpy()
+    city = training_data['city_id'].to_numpy()[connected]
+    previous_city = previous_city.to_numpy()[connected].astype(city.dtype)
+
+    pairs = pd.DataFrame({'city_a': np.minimum(city, previous_city),
+                          'city_b': np.maximum(city, previous_city)})
+    return pairs.groupby(['city_a', 'city_b']).size()
+
+
+def trip_finish_counts(training_data: pd.DataFrame):
+    return training_data.groupby('utrip_id', sort=False)['city_id'].last().value_counts()
+
+
+def create_city_graph(training_data: pd.DataFrame):
+    ug = nx.Graph(directed=False)
+
+    # Nodes are cities
+    nodes = city_nodes(training_data)
+    ug.add_nodes_from((city_id, {'country': country, 'number_of_trips': number_of_trips})
+                      for city_id, country, number_of_trips in zip(nodes['city_id'],
+                                                                   nodes['hotel_country'],
+                                                                   nodes['utrip_id']))
+
+    # Edges are connecting cities by trip with a weighting of how often they are selected
+    edges = city_edge_counts(training_data)
+    ug.add_edges_from((city_a, city_b, {'weight': weight}) for (city_a, city_b), weight in edges.items())
+
+    nx.set_node_attributes(ug, trip_finish_counts(training_data).to_dict(), 'trip_finishes')
+    return ug
+
+
+def update_city_graph(graph: nx.Graph, previous_data: pd.DataFrame, delta_data: pd.DataFrame):
+    # previous_data holds the rows already in the graph for the trips which the delta continues,
+    # returns the edges which are new to the graph since only they change the triangles
+    combined = pd.concat([previous_data, delta_data])
+
+    nodes = city_nodes(delta_data)
+    for city_id, country, number_of_trips in zip(nodes['city_id'], nodes['hotel_country'], nodes['utrip_id']):
+        if city_id in graph:
+            graph.nodes[city_id]['number_of_trips'] += number_of_trips
+        else:
+            graph.add_node(city_id, country=country, number_of_trips=number_of_trips)
+
+    new_edges = []
+    edges = city_edge_counts(combined).sub(city_edge_counts(previous_data), fill_value=0)
+    for (city_a, city_b), weight in edges[edges != 0].astype(int).items():
+        if graph.has_edge(city_a, city_b):
+            graph[city_a][city_b]['weight'] += weight
+        else:
+            graph.add_edge(city_a, city_b, weight=weight)
+            new_edges.append((city_a, city_b))
+
+    # a continued trip moves its finish from the old last city to the new one
+    finishes = trip_finish_counts(combined).sub(trip_finish_counts(previous_data), fill_value=0)
+    for city_id, change in finishes[finishes != 0].astype(int).items():
+        trip_finishes = graph.nodes[city_id].get('trip_finishes', 0) + change
+        if trip_finishes:
+            graph.nodes[city_id]['trip_finishes'] = trip_finishes
+        else:
+            del graph.nodes[city_id]['trip_finishes']
+
+    return new_edges
+
+
+def triangle_nodes(graph: nx.Graph, new_edges: list):
+    # a new edge only adds triangles for its two cities and the cities connected to both
+    nodes = set()
+    for city_a, city_b in new_edges:
+        nodes.update([city_a, city_b])
+        nodes.update(set(graph[city_a]) & set(graph[city_b]))
+    return sorted(nodes)
+
+
 def create_sparse_matrix(input_data: zip, matrix_size: torch.Size):
     xs = []
     ys = []
@@ -41,25 +133,169 @@ def create_sparse_matrix(input_data: zip, matrix_size: torch.Size):
     return sparse_matrix
 
 
+def create_csr_matrix(rows: np.ndarray, columns: np.ndarray, values: np.ndarray, matrix_size: tuple):
+    # duplicate (row, column) entries are summed, matching to_dense on the coo tensors
+    return sparse.csr_matrix((values.astype(np.float32), (rows, columns)), shape=matrix_size)
+
+
+def sparse_row(matrix: sparse.csr_matrix, row: int, number_of_rows=1):
+    start, end = matrix.indptr[row], matrix.indptr[row + number_of_rows]
+    rows = np.repeat(np.arange(number_of_rows), np.diff(matrix.indptr[row:row + number_of_rows + 1]))
+
+    return create_sparse_matrix(input_data=zip(matrix.indices[start:end], rows, matrix.data[start:end]),
+                                matrix_size=torch.Size([number_of_rows, matrix.shape[1]]))
+
+
+def add_stay_columns(bookings: pd.DataFrame):
+    bookings['checkin_date'] = pd.to_datetime(bookings['checkin'])
+    bookings['checkout_date'] = pd.to_datetime(bookings['checkout'])
+    bookings['days'] = bookings['checkout_date'] - bookings['checkin_date']
+    return bookings
+
+
+def build_trip_features(trip_data: pd.DataFrame, history_data: pd.DataFrame, number_of_cities: int):
+    # every trip becomes a contiguous block, in trip_id then check-in order
+    trip_data = trip_data.sort_values(['utrip_id', 'checkin_date'], kind='mergesort')
+    trip_data = trip_data.reset_index(drop=True)
+    cities = trip_data['city_id'].to_numpy()
+    days = trip_data['days'].dt.days.to_numpy()
+
+    trips = trip_data.reset_index().groupby('utrip_id', sort=True).agg(
+        trip_start=('index', 'first'),
+        trip_length=('index', 'size'),
+        user_id=('user_id', 'first'),
+        starting_date=('checkin_date', 'first'))
+    number_of_trips = len(trips)
+    trip_length = trips['trip_length'].to_numpy()
+    trip_end = trips['trip_start'].to_numpy() + trip_length
+
+    final_city = cities[trip_end - 1]
+    current_city = np.where(trip_length > 1, cities[np.maximum(trip_end - 2, 0)], 0)
+
+    # every stay of the trip apart from the final city
+    trip_rows = np.repeat(np.arange(number_of_trips), trip_length)
+    previous_stay = np.arange(len(cities)) < np.repeat(trip_end - 1, trip_length)
+    trip_cities = create_csr_matrix(rows=trip_rows[previous_stay],
+                                    columns=cities[previous_stay],
+                                    values=days[previous_stay],
+                                    matrix_size=(number_of_trips, number_of_cities))
+
+    # stays of the same user which checked in before the trip started
+    history = UserHistory.from_bookings(history_data)
+    previous_cities = history.previous_cities(users=trips['user_id'].to_numpy(),
+                                              times=trips['starting_date'],
+                                              number_of_cities=number_of_cities)
+
+    return {'trip_id': trips.index.to_numpy().astype(str),
+            'final_city': final_city,
+            'current_city': current_city,
+            'trip_cities': trip_cities,
+            'previous_cities': previous_cities}
+
+
+def merge_trip_features(trips: dict, updated_trips: dict):
+    # swap the rows of the rebuilt trips into the store, keeping the trip_id order
+    keep = np.flatnonzero(~np.isin(trips['trip_id'], updated_trips['trip_id']))
+    trip_id = np.concatenate([trips['trip_id'][keep], updated_trips['trip_id']])
+    order = np.argsort(trip_id, kind='stable')
+    number_of_cities = max(trips['trip_cities'].shape[1], updated_trips['trip_cities'].shape[1])
+
+    merged = {'trip_id': trip_id[order]}
+    for name in ['final_city', 'current_city']:
+        merged[name] = np.concatenate([trips[name][keep], updated_trips[name]])[order]
+    for name in ['trip_cities', 'previous_cities']:
+        matrices = [_resize_columns(trips[name][keep], number_of_cities),
+                    _resize_columns(updated_trips[name], number_of_cities)]
+        merged[name] = sparse.vstack(matrices, format='csr')[order]
+
+    return merged
+
+
+def _resize_columns(matrix: sparse.csr_matrix, number_of_columns: int):
+    return sparse.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], number_of_columns))
+
+
+def save_feature_store(location: Path, arrays: dict):
+    # flat .npy files plus a manifest, the manifest is written last so a partial store is never opened.
+    # the store is written next to the old one and swapped in, the old files may still be memory mapped
+    final_location = location
+    location = location.with_name(location.name + '_partial')
+    if location.exists():
+        shutil.rmtree(location)
+    location.mkdir(parents=True)
+    manifest = {'version': FEATURE_STORE_VERSION, 'arrays': {}, 'matrices': {}}
+
+    for name, value in arrays.items():
+        if sparse.issparse(value):
+            value = value.tocsr()
+            manifest['matrices'][name] = {'shape': list(value.shape)}
+            for part in ['indptr', 'indices', 'data']:
+                _save_array(location, f'{name}_{part}', getattr(value, part), manifest)
+        else:
+            _save_array(location, name, np.asarray(value), manifest)
+
+    with open(location / 'manifest.json', 'w') as outfile:
+        json.dump(manifest, outfile, indent=2)
+
+    if final_location.exists():
+        shutil.rmtree(final_location)
+    location.rename(final_location)
+
+
+def load_feature_store(location: Path):
+    with open(location / 'manifest.json', 'r') as infile:
+        manifest = json.load(infile)
+
+    if manifest['version'] != FEATURE_STORE_VERSION:
+        raise ValueError(f"Feature store {location} is version {manifest['version']}, "
+                         f"expected {FEATURE_STORE_VERSION}, rerun the cache setup")
+
+    # memory mapped so every DataLoader worker shares the same pages through the OS page cache
+    arrays = {name: np.load(location / details['file'], mmap_mode='r')
+              for name, details in manifest['arrays'].items()}
+
+    for name, details in manifest['matrices'].items():
+        arrays[name] = sparse.csr_matrix((arrays.pop(f'{name}_data'),
+                                          arrays.pop(f'{name}_indices'),
+                                          arrays.pop(f'{name}_indptr')),
+                                         shape=tuple(details['shape']),
+                                         copy=False)
+
+    return arrays
+
+
+def _save_array(location: Path, name: str, array: np.ndarray, manifest: dict):
+    np.save(location / f'{name}.npy', array)
+    manifest['arrays'][name] = {'file': f'{name}.npy',
+                                'dtype': str(array.dtype),
+                                'shape': list(array.shape)}
+
+
 class BookingLoader(torch.utils.data.Dataset):
-    def __init__(self, trips, connected_node_features, training, training_percentage, number_of_classes, seed=1994):
+    def __init__(self, trips, connected_node_features, training, training_percentage, number_of_classes, seed=1994,
+                 sparse_input=False, index_targets=False):
         super(BookingLoader).__init__()
         self.trips = trips
         self.connected_node_features = connected_node_features
         self.training = training
         self.training_percentage = training_percentage
         self.number_of_classes = number_of_classes
+        self.sparse_input = sparse_input
+        # the final city as an integer rather than a one hot vector over every city
+        self.index_targets = index_targets
 
         rand.seed(seed)
         np.random.seed(seed)
 
-        self.k = int(round(len(self.trips.keys()) * self.training_percentage))
-        self.indices = rand.sample(self.trips.keys(), self.k)
+        # trips are rows of the trip_properties csr matrices, sampled in trip_id order
+        number_of_trips = len(self.trips['trip_id'])
+        self.k = int(round(number_of_trips * self.training_percentage))
+        self.indices = rand.sample(range(number_of_trips), self.k)
         if not self.training:
-            self.indices = [x for x in trips.keys() if x not in self.indices]
+            selected = set(self.indices)
+            self.indices = [x for x in range(number_of_trips) if x not in selected]
+        self.indices = np.array(self.indices, dtype=np.int64)
 
-        self.sample_trips = [self.trips[index] for index in self.indices]
-        self.n = 0
         self.start = 0
         self.end = len(self.indices)
 
@@ -69,41 +305,257 @@ class BookingLoader(torch.utils.data.Dataset):
         return a
 
     def load_sample(self, index):
-        dict_key = self.indices[index]
-        final_city = self.trips[dict_key]['final_city']
+        row = self.indices[index]
+        final_city = self.trips['final_city'][row]
 
-        if self.trips[dict_key]['current_city'] == 0:
-            self.trips[dict_key]['current_city'] = 2
+        current_city = self.trips['current_city'][row]
+        if current_city == 0:
+            current_city = 2
 
-        connected_node_features = self.connected_node_features[self.trips[dict_key]['current_city']]
-        trip_cities = self.trips[dict_key]['trip_cities']
-        previous_cities = self.trips[dict_key]['previous_cities']
+        # closeness, betweenness and triangles rows of the connected cities
+        connected_node_features = sparse.vstack([self.connected_features(np.array([current_city]), x)
+                                                 for x in range(3)]).tocsr()
+        connected_node_features = sparse_row(connected_node_features, 0, 3)
+        trip_cities = sparse_row(self.trips['trip_cities'], row)
+        previous_cities = sparse_row(self.trips['previous_cities'], row)
 
-        return self.get_one_hot(final_city), trip_cities, previous_cities, connected_node_features, dict_key
-
-    def __next__(self):
-        if self.n < self.end:
-            n = self.n
-            final_city, trip_cities, previous_cities, connected_node_features, trip_id = self.__getitem__(n)
-            self.n += 1
-            return final_city, trip_cities, previous_cities, connected_node_features, trip_id
+        if self.index_targets:
+            final_city = torch.tensor(final_city, dtype=torch.long)
         else:
-            self.n = 0
-            raise StopIteration
+            final_city = self.get_one_hot(final_city)
+
+        return (final_city, trip_cities, previous_cities, connected_node_features, torch.tensor(current_city),
+                self.trips['trip_id'][row])
+
+    def connected_features(self, current_city: np.ndarray, feature: int):
+        return connected_features(self.connected_node_features, current_city, feature)
+
+    def batch_rows(self, matrix: sparse.csr_matrix, rows: np.ndarray):
+        return self.to_tensor(matrix[rows])
+
+    def to_tensor(self, batch: sparse.csr_matrix):
+        return csr_to_tensor(batch, self.sparse_input)
+
+    def load_batch(self, indices):
+        # one fancy-indexed slice of each csr matrix for the whole batch, densified at most once
+        rows = self.indices[indices]
+        batch_size = len(rows)
+
+        final_city = torch.from_numpy(np.asarray(self.trips['final_city'][rows], dtype=np.int64))
+        if not self.index_targets:
+            one_hot = torch.zeros(batch_size, self.number_of_classes, dtype=torch.float)
+            one_hot[torch.arange(batch_size), final_city] = 1
+            final_city = one_hot
+
+        current_city = np.asarray(self.trips['current_city'][rows])
+        current_city = np.where(current_city == 0, 2, current_city)
+        # closeness, betweenness and triangles as separate csr batches, or one dense batch x 3 x cities tensor
+        node_features = tuple(self.to_tensor(self.connected_features(current_city, x)) for x in range(3))
+        if not self.sparse_input:
+            node_features = torch.cat(node_features, 1)
+
+        return (final_city,
+                self.batch_rows(self.trips['trip_cities'], rows),
+                self.batch_rows(self.trips['previous_cities'], rows),
+                node_features,
+                torch.from_numpy(current_city.astype(np.int64)),
+                [str(x) for x in self.trips['trip_id'][rows]])
 
     def __getitem__(self, index):
-        final_city, trip_cities, previous_cities, connected_node_features, trip_id = self.load_sample(index)
-        return final_city, trip_cities, previous_cities, connected_node_features, trip_id
+        if isinstance(index, list):
+            return self.load_batch(index)
+
+        final_city, trip_cities, previous_cities, connected_node_features, current_city, trip_id = self.load_sample(index)
+        return final_city, trip_cities, previous_cities, connected_node_features, current_city, trip_id
 
     def __len__(self):
         return self.end
 
 
+def connected_features(connected_node_features: dict, current_city: np.ndarray, feature: int):
+    # neighbours of each current city, valued with the shared network feature of the neighbour
+    batch = connected_node_features['neighbours'][current_city]
+    batch.data = np.asarray(connected_node_features['network_features'][feature, batch.indices], dtype=np.float32)
+    return batch
+
+
+def csr_to_tensor(batch: sparse.csr_matrix, sparse_input=False):
+    # a torch csr tensor for the sparse first layer, otherwise dense batch x 1 x cities
+    if sparse_input:
+        return torch.sparse_csr_tensor(torch.from_numpy(batch.indptr.astype(np.int64)),
+                                       torch.from_numpy(batch.indices.astype(np.int64)),
+                                       torch.from_numpy(batch.data.astype(np.float32)),
+                                       size=batch.shape)
+
+    return torch.from_numpy(batch.toarray()).unsqueeze(1)
+
+
+def create_batch_loader(dataset: BookingLoader, batch_size: int, shuffle=False, device='cpu', loader_config=None):
+    # the sampler hands BookingLoader a list of indices, so a batch is fetched in one call with no collate step
+    if shuffle:
+        sampler = torch.utils.data.RandomSampler(dataset)
+    else:
+        sampler = torch.utils.data.SequentialSampler(dataset)
+
+    return data_loading.create_data_loader(dataset,
+                                           sampler=torch.utils.data.BatchSampler(sampler, batch_size, drop_last=False),
+                                           batch_size=None,
+                                           device=device,
+                                           loader_config=loader_config)
+
+
+def split_node_features(node_features, device):
+    # closeness, betweenness and triangles from either loader output
+    if isinstance(node_features, (tuple, list)):
+        return [x.to(device) for x in node_features]
+
+    node_features = node_features.to(device)
+    return node_features[:, 0:1, ], node_features[:, 1:2, ], node_features[:, 2:, ]
+
+
+def valid_cities(closeness: torch.Tensor, start=0, end=None):
+    # cities connected to the current city, optionally only the columns start to end
+    if closeness.layout == torch.sparse_csr:
+        end = closeness.shape[-1] if end is None else end
+        rows = torch.repeat_interleave(torch.arange(closeness.shape[0], device=closeness.device),
+                                       closeness.crow_indices().diff())
+        columns = closeness.col_indices()
+        keep = (columns >= start) & (columns < end) & (closeness.values() > 0)
+
+        mask = torch.zeros(closeness.shape[0], end - start, dtype=torch.bool, device=closeness.device)
+        mask[rows[keep], columns[keep] - start] = True
+        return mask
+
+    return closeness[..., start:end] > 0
+
+
+def top_cities(model: nn.Module, closeness, betweenness, triangles, trip_cities, previous_cities, k=4,
+               city_chunk_size=None):
+    # top k of the masked logits, computed over blocks of cities so the full logits matrix never exists
+    hidden = model.hidden(closeness, betweenness, triangles, trip_cities, previous_cities)
+    return top_hidden_cities(model.classifier[-1], hidden, closeness, k, city_chunk_size)
+
+
+def top_hidden_cities(output_layer: nn.Linear, hidden: torch.Tensor, closeness, k=4, city_chunk_size=None, rows=None):
+    # top_cities from the output of model.hidden, rows is a mask of the trips of closeness that hidden belongs to
+    city_chunk_size = city_chunk_size or output_layer.out_features
+
+    best_values = None
+    best_cities = None
+    for start in range(0, output_layer.out_features, city_chunk_size):
+        end = min(start + city_chunk_size, output_layer.out_features)
+        logits = F.linear(hidden, output_layer.weight[start:end], output_layer.bias[start:end])
+        valid = valid_cities(closeness, start, end)
+        if rows is not None:
+            valid = valid[rows]
+        logits = logits.masked_fill(~valid.reshape(logits.shape), -float('inf'))
+        values, cities = logits.topk(min(k, end - start))
+        cities = cities + start
+
+        if best_values is not None:
+            values = torch.cat([best_values, values], -1)
+            cities = torch.cat([best_cities, cities], -1)
+            values, position = values.topk(min(k, values.shape[-1]))
+            cities = cities.gather(-1, position)
+        best_values, best_cities = values, cities
+
+    return best_cities
+
+
+def top_candidate_cities(model: nn.Module, closeness, betweenness, triangles, trip_cities, previous_cities,
+                         candidates: torch.Tensor, filled: torch.Tensor, k=4, city_chunk_size=None):
+    # scores only the candidate cities of each trip with the matching rows of the final layer. trips with fewer than
+    # k candidates, such as a current city that isn't in the graph, are scored against every city like top_cities
+    hidden = model.hidden(closeness, betweenness, triangles, trip_cities, previous_cities)
+    hidden = hidden.reshape(candidates.shape[0], -1)
+    output_layer = model.classifier[-1]
+
+    logits = torch.bmm(output_layer.weight[candidates], hidden.unsqueeze(-1)).squeeze(-1) + output_layer.bias[candidates]
+    logits = logits.masked_fill(~filled, -float('inf'))
+    _, position = logits.topk(min(k, candidates.shape[1]))
+    selected = candidates.gather(-1, position)
+
+    short = filled.sum(-1) < k
+    if short.any():
+        fallback = top_hidden_cities(output_layer, hidden[short], closeness, k, city_chunk_size, rows=short)
+        # every trip is short when there are fewer than k candidate slots
+        if short.all():
+            return fallback
+        selected[short] = fallback
+    return selected
+
+
+def sampled_softmax_loss(output_layer: nn.Linear, hidden: torch.Tensor, final_city: torch.Tensor, number_of_samples: int,
+                         final_city_frequency: torch.Tensor, valid: torch.Tensor = None):
+    # softmax over each trip's final city, the other final cities in the batch and number_of_samples cities drawn
+    # uniformly without replacement instead of over every city. the batch's final cities are drawn by how often each
+    # city ends a trip, so every logit has the log of its expected number of draws taken off and popular cities
+    # aren't pushed down more than the full softmax would. valid is the batch x cities mask of valid_cities, the
+    # negatives outside it are left out as they are at prediction time
+    hidden = hidden.reshape(final_city.shape[0], -1)
+    sampled = torch.randperm(output_layer.out_features, device=final_city.device)[:number_of_samples]
+    cities = torch.cat([final_city, sampled])
+    logits = F.linear(hidden, output_layer.weight[cities], output_layer.bias[cities])
+    expected_draws = final_city.shape[0] * final_city_frequency[cities] + len(sampled) / output_layer.out_features
+    logits = logits - torch.log(expected_draws)
+
+    # other copies of a trip's own final city are not negatives
+    targets = torch.arange(final_city.shape[0], device=final_city.device)
+    excluded = cities.unsqueeze(0) == final_city.unsqueeze(1)
+    if valid is not None:
+        excluded |= ~valid.reshape(final_city.shape[0], -1)[:, cities]
+    excluded[targets, targets] = False
+    logits = logits.masked_fill(excluded, -float('inf'))
+
+    return F.cross_entropy(logits, targets)
+
+
+def stack_sparse_rows(tensors: list):
+    # concatenate csr tensors along the first dimension
+    crow_indices = [tensors[0].crow_indices()[:1]]
+    nnz = 0
+    for x in tensors:
+        crow_indices.append(x.crow_indices()[1:] + nnz)
+        nnz += x.values().shape[0]
+
+    return torch.sparse_csr_tensor(torch.cat(crow_indices),
+                                   torch.cat([x.col_indices() for x in tensors]),
+                                   torch.cat([x.values() for x in tensors]),
+                                   size=(sum(x.shape[0] for x in tensors), tensors[0].shape[1]))
+
+
+class SparseLinear(nn.Module):
+    # nn.Linear stored as an embedding table, a csr input only touches the weights of its non-zero columns
+    def __init__(self, in_features, out_features) -> None:
+        super(SparseLinear, self).__init__()
+        self.weight = nn.Parameter(torch.empty(in_features, out_features))
+        self.bias = nn.Parameter(torch.empty(out_features))
+
+        # same initialisation as nn.Linear
+        bound = 1 / math.sqrt(in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if x.layout == torch.sparse_csr:
+            x = F.embedding_bag(x.col_indices(), self.weight, x.crow_indices()[:-1],
+                                mode='sum', per_sample_weights=x.values())
+        else:
+            x = x.matmul(self.weight)
+        return x + self.bias
+
+
 class LinearNN(nn.Module):
-    def __init__(self, city_numbers) -> None:
+    def __init__(self, city_numbers, sparse_input=False, fuse_inputs=False) -> None:
         super(LinearNN, self).__init__()
+        self.fuse_inputs = fuse_inputs
+        if sparse_input:
+            first_layer = SparseLinear(city_numbers, 2048)
+        else:
+            first_layer = nn.Linear(city_numbers, 2048)
+
         self.fc = nn.Sequential(
-            nn.Linear(city_numbers, 2048),
+            first_layer,
             nn.ELU(inplace=True),
             nn.Dropout(p=0.3),
             nn.Linear(2048, 4096),
@@ -130,13 +582,37 @@ class LinearNN(nn.Module):
                 triangles: torch.Tensor,
                 trip_cities: torch.Tensor,
                 previous_cities: torch.Tensor,) -> torch.Tensor:
-        closeness_fc = self.fc(closeness)
-        betweenness_fc = self.fc(betweenness)
-        triangles_fc = self.fc(triangles)
-        trip_cities_fc = self.fc(trip_cities)
-        previous_cities_fc = self.fc(previous_cities)
+        x = self.hidden(closeness, betweenness, triangles, trip_cities, previous_cities)
+        x = self.classifier[-1](x)
+        return x
+
+    def hidden(self,
+               closeness: torch.Tensor,
+               betweenness: torch.Tensor,
+               triangles: torch.Tensor,
+               trip_cities: torch.Tensor,
+               previous_cities: torch.Tensor,) -> torch.Tensor:
+        # everything up to the final city layer
+        inputs = [closeness, betweenness, triangles, trip_cities, previous_cities]
+        if closeness.layout == torch.sparse_csr:
+            x = self.fc_stacked(stack_sparse_rows(inputs), len(inputs))
+        # models saved before fuse_inputs existed run the five towers separately
+        elif getattr(self, 'fuse_inputs', False):
+            x = self.fc_stacked(torch.cat(inputs), len(inputs))
+        else:
+            closeness_fc = self.fc(closeness)
+            betweenness_fc = self.fc(betweenness)
+            triangles_fc = self.fc(triangles)
+            trip_cities_fc = self.fc(trip_cities)
+            previous_cities_fc = self.fc(previous_cities)
+
+            x = closeness_fc + betweenness_fc + triangles_fc + trip_cities_fc + previous_cities_fc
 
-        x = closeness_fc + betweenness_fc + triangles_fc + trip_cities_fc + previous_cities_fc
         x = self.features(x)
-        x = self.classifier(x)
+        x = self.classifier[:-1](x)
         return x
+
+    def fc_stacked(self, inputs: torch.Tensor, number_of_inputs: int) -> torch.Tensor:
+        # all inputs go through the shared fc tower as one batch, then summed
+        x = self.fc(inputs)
+        return x.view(number_of_inputs, -1, *x.shape[1:]).sum(0)
@@ -0,0 +1,118 @@
+import hashlib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import networkx as nx
+import pickle as pkl
+
+import bookingdotcom.helper_functions as helper_functions
+from bookingdotcom.city_graph import CityGraph
+from bookingdotcom.user_history import UserHistory
+
+# Patches the caches from create_networkx.py, graph_metrics_calculation.py and setup_data.py with a delta of new
+# bookings, a delta is only applied once. Betweenness and closeness are global so they are left as they are, new cities get 0 until the next full run
+cache_location = Path('bookingdotcom/cache/')
+graph_data_path = Path('../data/bookingdotcom/training_dataset/booking_train_set.csv')
+trip_data_path = Path('../data/bookingdotcom/test_dataset/booking_train_set.csv')
+testing_data_path = Path('../data/bookingdotcom/test_dataset/booking_test_set.csv')
+delta_data_path = Path('../data/bookingdotcom/delta/booking_delta.csv')
+# add the delta to the source csvs so the next full run includes it
+append_delta = False
+
+delta_data = helper_functions.add_stay_columns(pd.read_csv(delta_data_path, index_col=0))
+
+# Graph, the delta can continue trips which are already in the graph
+graph_data = pd.read_csv(graph_data_path, index_col=0)
+previous_data = graph_data[graph_data['utrip_id'].isin(delta_data['utrip_id'])]
+
+with open(cache_location / 'network_graph.pkl', mode='rb') as file:
+    booking_graph = pkl.load(file)
+
+# the graph records the deltas patched into the caches, a full run of create_networkx.py starts the record again.
+# a delta already in the source csv was appended by an earlier run, so a full run has counted it
+with open(delta_data_path, mode='rb') as file:
+    delta_hash = hashlib.sha1(file.read()).hexdigest()
+applied_deltas = booking_graph.graph.setdefault('applied_deltas', [])
+already_appended = previous_data.merge(delta_data[['utrip_id', 'checkin']], on=['utrip_id', 'checkin'])
+if delta_hash in applied_deltas or len(already_appended) > 0:
+    raise ValueError(f"{delta_data_path} has already been applied")
+
+new_edges = helper_functions.update_city_graph(booking_graph, previous_data, delta_data)
+applied_deltas.append(delta_hash)
+with open(cache_location / 'network_graph.pkl', mode='wb') as file:
+    pkl.dump(booking_graph, file, pkl.HIGHEST_PROTOCOL)
+print(f"Graph updated.. new edges: {len(new_edges)}")
+
+# Triangles
+with open(cache_location / 'triangles.pkl', mode='rb') as file:
+    triangles = pkl.load(file)
+
+affected_nodes = helper_functions.triangle_nodes(booking_graph, new_edges)
+affected_nodes += [x for x in booking_graph if x not in triangles]
+triangles.update(nx.triangles(booking_graph, affected_nodes))
+
+with open(cache_location / 'triangles.pkl', mode='wb') as file:
+    pkl.dump(triangles, file)
+print(f"Triangles updated.. cities: {len(affected_nodes)}")
+
+# Network features
+with open(cache_location / 'network_features.pkl', mode='rb') as file:
+    old_network_features = pkl.load(file)
+
+network_features = np.zeros((3, max(max(booking_graph) + 1, old_network_features.shape[1])))
+network_features[:, :old_network_features.shape[1]] = old_network_features
+network_features[2, affected_nodes] = [triangles[x] for x in affected_nodes]
+
+with open(cache_location / 'network_features.pkl', mode='wb') as file:
+    pkl.dump(network_features, file)
+
+city_graph = CityGraph.from_networkx(booking_graph)
+number_of_nodes = network_features.shape[1]
+neighbours = helper_functions.create_csr_matrix(rows=np.repeat(city_graph.nodes, np.diff(city_graph.indptr)),
+                                                columns=city_graph.nodes[city_graph.indices],
+                                                values=np.ones(len(city_graph.indices)),
+                                                matrix_size=(number_of_nodes, number_of_nodes))
+
+helper_functions.save_feature_store(cache_location / 'connected_node_features',
+                                    {'neighbours': neighbours,
+                                     'network_features': network_features.astype(np.float32)})
+
+# Trip features, every trip of a user in the delta as their history has changed
+trip_data = helper_functions.add_stay_columns(pd.read_csv(trip_data_path, index_col=0))
+testing_data = helper_functions.add_stay_columns(pd.read_csv(testing_data_path))
+users = delta_data['user_id'].unique()
+user_data = pd.concat([trip_data[trip_data['user_id'].isin(users)], delta_data])
+
+trips = helper_functions.load_feature_store(cache_location / 'trip_properties')
+number_of_cities = max(trips['trip_cities'].shape[1], max(delta_data['city_id']) + 1)
+updated_trips = helper_functions.build_trip_features(trip_data=user_data,
+                                                     history_data=user_data,
+                                                     number_of_cities=number_of_cities)
+merged_trips = helper_functions.merge_trip_features(trips, updated_trips)
+
+# release the memory mapped files before they are replaced
+del trips
+helper_functions.save_feature_store(cache_location / 'trip_properties', merged_trips)
+print(f"Trip features updated.. users: {len(users)}.. trips: {len(updated_trips['trip_id'])}")
+
+# testing trips look back over the users' stays in both sets, as in setup_data.py
+testing_user_data = testing_data[testing_data['user_id'].isin(users)]
+testing_trips = helper_functions.load_feature_store(cache_location / 'test_trip_properties')
+updated_testing_trips = helper_functions.build_trip_features(trip_data=testing_user_data,
+                                                             history_data=pd.concat([user_data, testing_user_data]),
+                                                             number_of_cities=number_of_cities)
+merged_testing_trips = helper_functions.merge_trip_features(testing_trips, updated_testing_trips)
+
+del testing_trips
+helper_functions.save_feature_store(cache_location / 'test_trip_properties', merged_testing_trips)
+print(f"Testing trip features updated.. trips: {len(updated_testing_trips['trip_id'])}")
+
+# User history, sorting every stay again is cheap next to the trip features
+all_trips = pd.concat([trip_data, testing_data, delta_data])
+helper_functions.save_feature_store(cache_location / 'user_history', UserHistory.from_bookings(all_trips).to_arrays())
+print(f"User history updated.. stays: {len(all_trips)}")
+
+if append_delta:
+    for data_path in {graph_data_path, trip_data_path}:
+        columns = pd.read_csv(data_path, index_col=0, nrows=0).columns
+        delta_data[columns].to_csv(data_path, mode='a', header=False)
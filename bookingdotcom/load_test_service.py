@@ -0,0 +1,79 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import bookingdotcom.helper_functions as helper_functions
+
+# Replays partial trips from the test set against a running scoring_service.py and reports latency and throughput
+testing_data_path = Path('../data/bookingdotcom/test_dataset/booking_test_set.csv')
+host = '127.0.0.1'
+port = 8080
+number_of_requests = 5000
+concurrency = 64
+
+
+def trip_requests(testing_data: pd.DataFrame, number_of_requests: int):
+    # the last stay of each test trip is the city to predict, everything before it makes up the request
+    testing_data = testing_data.sort_values(['utrip_id', 'checkin_date'], kind='mergesort')
+    requests = []
+    for _, trip in testing_data.groupby('utrip_id', sort=False):
+        requests.append({'user_id': int(trip['user_id'].iloc[0]),
+                         'cities': trip['city_id'].iloc[:-1].tolist(),
+                         'days': trip['days'].dt.days.iloc[:-1].tolist(),
+                         'starting_date': str(trip['checkin_date'].iloc[0])})
+        if len(requests) == number_of_requests:
+            break
+
+    return requests
+
+
+async def client(requests: asyncio.Queue, latencies: list, errors: list):
+    reader, writer = await asyncio.open_connection(host, port)
+    while not requests.empty():
+        body = json.dumps(requests.get_nowait()).encode()
+        start = time.perf_counter()
+        writer.write(f'POST /predict HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+
+        status = await reader.readline()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        await reader.readexactly(int(headers['content-length']))
+
+        latencies.append(time.perf_counter() - start)
+        if b' 200 ' not in status:
+            errors.append(status)
+    writer.close()
+
+
+async def load_test(requests: list):
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(queue, latencies, errors) for _ in range(concurrency)])
+    return np.array(latencies), errors, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    testing_data = helper_functions.add_stay_columns(pd.read_csv(testing_data_path))
+    latencies, errors, elapsed = asyncio.run(load_test(trip_requests(testing_data, number_of_requests)))
+
+    print(f"Requests: {len(latencies)}.. errors: {len(errors)}.. concurrency: {concurrency}")
+    print(f"Throughput: {len(latencies) / elapsed:.1f} requests/s")
+    print(f"Latency p50: {np.percentile(latencies, 50) * 1000:.1f}ms.. "
+          f"p99: {np.percentile(latencies, 99) * 1000:.1f}ms.. "
+          f"max: {latencies.max() * 1000:.1f}ms")
@@ -3,6 +3,7 @@ import torch
 import pandas as pd
 
 import bookingdotcom.helper_functions as helper_functions
+from bookingdotcom.city_graph import CityGraph
 
 cache_location = Path('bookingdotcom/cache/')
 epochs = 1000
@@ -12,46 +13,57 @@ device = 'cpu'
 model_location = Path('models/bookingdotcom/')
 config_file = model_location / 'metadata.json'
 model_path = model_location / 'booking_model_11.pth'
+output_path = model_location / 'output.csv'
+# memory is bounded by the batch size times the city chunk size rather than the size of the test set
+batch_size = 1000
+city_chunk_size = 8192
+# score only this many cities per trip, taken from the current city's neighbourhood, None scores every city
+number_of_candidates = 300
 
-connected_node_features = torch.load(cache_location / 'connected_node_features.pkl')
-trips = torch.load(cache_location / 'test_trip_properties.pkl')
-
-test_loader = torch.utils.data.DataLoader(
-    helper_functions.BookingLoader(trips=trips.copy(),
-                                   connected_node_features=connected_node_features.copy(),
-                                   training=True,
-                                   number_of_classes=67566,
-                                   training_percentage=1),
-    batch_size=8000)
-
+connected_node_features = helper_functions.load_feature_store(cache_location / 'connected_node_features')
+trips = helper_functions.load_feature_store(cache_location / 'test_trip_properties')
+city_graph = CityGraph.from_gpickle(cache_location / 'network_graph.pkl')
 
 model = torch.load(model_path)
 model.eval()
-output = []
+model.fuse_inputs = True
+sparse_input = isinstance(model.fc[0], helper_functions.SparseLinear)
 
-with torch.no_grad():
-    for test_final_city, test_trip_cities, test_previous_cities, test_node_features, trip_id in test_loader:
-        test_trip_cities = test_trip_cities.to_dense().to(device)
-        test_previous_cities = test_previous_cities.to_dense().to(device)
-        closeness = test_node_features.to_dense()[:, 0:1, ].to(device)
-        betweenness = test_node_features.to_dense()[:, 1:2, ].to(device)
-        triangles = test_node_features.to_dense()[:, 2:, ].to(device)
-        test_final_city = test_final_city.to(device)
+test_loader = helper_functions.create_batch_loader(
+    helper_functions.BookingLoader(trips=trips,
+                                   connected_node_features=connected_node_features,
+                                   training=True,
+                                   number_of_classes=67566,
+                                   training_percentage=1,
+                                   sparse_input=sparse_input),
+    batch_size=batch_size)
 
-        test_logps = model(closeness, betweenness, triangles, test_trip_cities, test_previous_cities)
 
-        valid_cities = (closeness > 0).float()
-        test_logps = test_logps * valid_cities
+# each batch is appended to the csv as soon as it is scored
+output_path.unlink(missing_ok=True)
+write_header = True
 
-        selected_city = test_logps.topk(4)
+with torch.no_grad():
+    for test_final_city, test_trip_cities, test_previous_cities, test_node_features, current_city, trip_id in test_loader:
+        test_trip_cities = test_trip_cities.to(device)
+        test_previous_cities = test_previous_cities.to(device)
+        closeness, betweenness, triangles = helper_functions.split_node_features(test_node_features, device)
 
-        selected_cities = selected_city[1].squeeze(1).detach().numpy()
-        indexes = trip_id
+        if number_of_candidates:
+            candidates, filled = city_graph.candidates(current_city.numpy(), number_of_candidates)
+            selected_cities = helper_functions.top_candidate_cities(model, closeness, betweenness, triangles,
+                                                                    test_trip_cities, test_previous_cities,
+                                                                    torch.from_numpy(candidates).to(device),
+                                                                    torch.from_numpy(filled).to(device), k=4,
+                                                                    city_chunk_size=city_chunk_size)
+        else:
+            selected_cities = helper_functions.top_cities(model, closeness, betweenness, triangles,
+                                                          test_trip_cities, test_previous_cities,
+                                                          k=4, city_chunk_size=city_chunk_size)
+        selected_cities = selected_cities.view(len(trip_id), -1).cpu().numpy()
 
         selected_cities = pd.DataFrame(selected_cities)
         selected_cities.index = trip_id
-        output.append(selected_cities)
+        selected_cities.to_csv(output_path, mode='a', header=write_header)
+        write_header = False
         print('done')
-
-final_output = pd.concat(output)
-final_output.to_csv(model_location / 'output.csv')
@@ -0,0 +1,219 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+
+import bookingdotcom.helper_functions as helper_functions
+from bookingdotcom.city_graph import CityGraph
+from bookingdotcom.user_history import UserHistory
+
+# Long lived next city scorer behind a local http endpoint, POST /predict with a json body of
+# {"user_id": 1000027, "cities": [8183, 15626], "days": [1, 2], "starting_date": "2016-08-13"}
+# answers {"cities": [the 4 most likely next cities]}
+cache_location = Path('bookingdotcom/cache/')
+model_path = Path('models/bookingdotcom/booking_model_11.pth')
+device = 'cpu'
+host = '127.0.0.1'
+port = 8080
+# requests arriving within max_wait seconds of each other share a forward pass
+max_batch_size = 64
+max_wait = 0.002
+city_chunk_size = 8192
+# score only this many cities from the current city's neighbourhood, None scores every city
+number_of_candidates = 300
+
+
+class NextCityScorer:
+    def __init__(self, model, connected_node_features, user_history: UserHistory, device='cpu', city_chunk_size=None,
+                 city_graph: CityGraph = None, number_of_candidates=None):
+        self.model = model.to(device)
+        self.model.eval()
+        self.model.fuse_inputs = True
+        self.sparse_input = isinstance(model.fc[0], helper_functions.SparseLinear)
+        self.number_of_cities = model.classifier[-1].out_features
+        self.connected_node_features = connected_node_features
+        self.user_history = user_history
+        self.device = device
+        self.city_chunk_size = city_chunk_size
+        self.city_graph = city_graph
+        self.number_of_candidates = number_of_candidates
+
+    @classmethod
+    def from_cache(cls, model_path: Path, cache_location: Path, device='cpu', city_chunk_size=None, number_of_candidates=None):
+        return cls(model=torch.load(model_path, map_location=device),
+                   connected_node_features=helper_functions.load_feature_store(cache_location / 'connected_node_features'),
+                   user_history=UserHistory.from_arrays(helper_functions.load_feature_store(cache_location / 'user_history')),
+                   device=device,
+                   city_chunk_size=city_chunk_size,
+                   city_graph=CityGraph.from_gpickle(cache_location / 'network_graph.pkl') if number_of_candidates else None,
+                   number_of_candidates=number_of_candidates)
+
+    @staticmethod
+    def current_cities(requests: list):
+        # an empty trip starts from city 2, as in training
+        return np.array([x['cities'][-1] if len(x['cities']) else 2 for x in requests], dtype=np.int64)
+
+    def build_inputs(self, requests: list):
+        # the five model inputs for a batch of partial trips, the same vectors BookingLoader builds from the cache
+        cities = [np.asarray(x['cities'], dtype=np.int64) for x in requests]
+        days = [np.asarray(x.get('days', np.ones(len(x['cities']))), dtype=np.float32) for x in requests]
+        if any(len(x) != len(y) for x, y in zip(cities, days)):
+            raise ValueError('cities and days must be the same length')
+        all_cities = np.concatenate(cities + [np.zeros(0, dtype=np.int64)])
+        if ((all_cities < 0) | (all_cities >= self.number_of_cities)).any():
+            raise ValueError(f'city ids must be between 0 and {self.number_of_cities - 1}')
+
+        current_city = self.current_cities(requests)
+        if (current_city >= self.connected_node_features['neighbours'].shape[0]).any():
+            raise ValueError('current city is not in the city graph')
+        node_features = [helper_functions.connected_features(self.connected_node_features, current_city, x)
+                         for x in range(3)]
+
+        trip_cities = helper_functions.create_csr_matrix(rows=np.repeat(np.arange(len(requests)), [len(x) for x in cities]),
+                                                         columns=all_cities,
+                                                         values=np.concatenate(days + [np.zeros(0)]),
+                                                         matrix_size=(len(requests), self.number_of_cities))
+
+        # previous stays are only looked up when the request has a user_id and starting_date
+        previous_cities = self.user_history.previous_cities(users=np.array([x.get('user_id', -1) for x in requests]),
+                                                            times=[x.get('starting_date', '1970-01-01') for x in requests],
+                                                            number_of_cities=self.number_of_cities)
+
+        return [helper_functions.csr_to_tensor(x, self.sparse_input).to(self.device)
+                for x in node_features + [trip_cities, previous_cities]]
+
+    def score(self, requests: list, k=4):
+        closeness, betweenness, triangles, trip_cities, previous_cities = self.build_inputs(requests)
+        with torch.no_grad():
+            if self.number_of_candidates:
+                candidates, filled = self.city_graph.candidates(self.current_cities(requests), self.number_of_candidates)
+                selected_cities = helper_functions.top_candidate_cities(self.model, closeness, betweenness, triangles,
+                                                                        trip_cities, previous_cities,
+                                                                        torch.from_numpy(candidates).to(self.device),
+                                                                        torch.from_numpy(filled).to(self.device), k=k,
+                                                                        city_chunk_size=self.city_chunk_size)
+            else:
+                selected_cities = helper_functions.top_cities(self.model, closeness, betweenness, triangles,
+                                                              trip_cities, previous_cities,
+                                                              k=k, city_chunk_size=self.city_chunk_size)
+
+        return selected_cities.view(len(requests), -1).cpu().tolist()
+
+
+class MicroBatcher:
+    # queues concurrent requests and scores them together, one batch at a time on a single worker thread
+    def __init__(self, scorer: NextCityScorer, max_batch_size=64, max_wait=0.002):
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batch_sizes = []
+
+    async def submit(self, request: dict):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batch_sizes.append(len(batch))
+            await self.score_batch(loop, batch)
+
+    async def score_batch(self, loop, batch):
+        requests = [request for request, _ in batch]
+        try:
+            results = await loop.run_in_executor(self.executor, self.scorer.score, requests)
+        except Exception:
+            # score the requests one by one so a bad request only fails itself
+            results = []
+            for request in requests:
+                try:
+                    results += await loop.run_in_executor(self.executor, self.scorer.score, [request])
+                except Exception as error:
+                    results.append(error)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+async def read_request(reader):
+    # request line, headers and body of one http request, None once the client has closed the connection
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    return method, path, body
+
+
+async def predict(body: bytes, batcher: MicroBatcher):
+    try:
+        return '200 OK', {'cities': await batcher.submit(json.loads(body))}
+    except (ValueError, KeyError, TypeError, AttributeError) as error:
+        return '400 Bad Request', {'error': str(error)}
+    except Exception as error:
+        return '500 Internal Server Error', {'error': str(error)}
+
+
+async def handle_connection(reader, writer, batcher: MicroBatcher):
+    # minimal http/1.1 with keep alive, enough for local clients and the load test
+    try:
+        while (request := await read_request(reader)) is not None:
+            method, path, body = request
+            if method != 'POST' or path != '/predict':
+                status, response = '404 Not Found', {'error': 'POST /predict'}
+            else:
+                status, response = await predict(body, batcher)
+
+            response = json.dumps(response).encode()
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(response)}\r\n\r\n'.encode() + response)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(scorer: NextCityScorer, host='127.0.0.1', port=8080, max_batch_size=64, max_wait=0.002):
+    batcher = MicroBatcher(scorer, max_batch_size=max_batch_size, max_wait=max_wait)
+    batch_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(reader, writer, batcher), host, port)
+    print(f"Serving on http://{host}:{port}/predict")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+if __name__ == '__main__':
+    next_city_scorer = NextCityScorer.from_cache(model_path, cache_location, device=device, city_chunk_size=city_chunk_size,
+                                                 number_of_candidates=number_of_candidates)
+    asyncio.run(serve(next_city_scorer, host=host, port=port, max_batch_size=max_batch_size, max_wait=max_wait))
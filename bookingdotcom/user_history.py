@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class UserHistory:
+    # every stay sorted by user then check-in, the stays of users[x] are the rows offsets[x]:offsets[x + 1]
+    def __init__(self, users, offsets, checkin, cities, days):
+        self.users = np.asarray(users)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        # check-in as seconds since the epoch
+        self.checkin = np.asarray(checkin, dtype=np.int64)
+        self.cities = np.asarray(cities, dtype=np.int64)
+        self.days = np.asarray(days, dtype=np.int64)
+
+    @classmethod
+    def from_bookings(cls, bookings: pd.DataFrame):
+        bookings = bookings.sort_values(['user_id', 'checkin_date'], kind='mergesort')
+        users, stays = np.unique(bookings['user_id'].to_numpy(), return_counts=True)
+
+        return cls(users=users,
+                   offsets=np.concatenate([[0], np.cumsum(stays)]),
+                   checkin=_seconds(bookings['checkin_date']),
+                   cities=bookings['city_id'].to_numpy(),
+                   days=bookings['days'].dt.days.to_numpy())
+
+    @classmethod
+    def from_arrays(cls, arrays: dict):
+        return cls(arrays['users'], arrays['offsets'], arrays['checkin'], arrays['cities'], arrays['days'])
+
+    def to_arrays(self):
+        return {'users': self.users,
+                'offsets': self.offsets,
+                'checkin': self.checkin,
+                'cities': self.cities,
+                'days': self.days}
+
+    def __len__(self):
+        return len(self.users)
+
+    def user_rows(self, users):
+        # first and last row of each user's stays, an empty range for unknown users
+        users = np.asarray(users)
+        if len(self.users) == 0:
+            return np.zeros(users.shape, dtype=np.int64), np.zeros(users.shape, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.users, users), len(self.users) - 1)
+        found = self.users[positions] == users
+        return np.where(found, self.offsets[positions], 0), np.where(found, self.offsets[positions + 1], 0)
+
+    def rows_before(self, users, times):
+        # binary search within each user's rows for the stays checked in strictly before the time, so a trip
+        # never sees its own stays or anything later
+        start, end = self.user_rows(users)
+        times = np.broadcast_to(_seconds(times), start.shape)
+        low, high = start.copy(), end.copy()
+        searching = low < high
+        while searching.any():
+            middle = (low + high) // 2
+            earlier = self.checkin[np.where(searching, middle, 0)] < times
+            low = np.where(searching & earlier, middle + 1, low)
+            high = np.where(searching & ~earlier, middle, high)
+            searching = low < high
+
+        return start, low
+
+    def before(self, user, time):
+        # cities and stay lengths of one user before a time
+        start, end = self.rows_before(np.array([user]), time)
+        return self.cities[start[0]:end[0]], self.days[start[0]:end[0]]
+
+    def previous_cities(self, users, times, number_of_cities: int):
+        # one row per query of the days stayed in each city beforehand
+        start, end = self.rows_before(users, times)
+        history_length = end - start
+        history_offsets = np.cumsum(history_length) - history_length
+        history_index = np.arange(history_length.sum()) + np.repeat(start - history_offsets, history_length)
+
+        return sparse.csr_matrix((self.days[history_index].astype(np.float32),
+                                  (np.repeat(np.arange(len(start)), history_length), self.cities[history_index])),
+                                 shape=(len(start), number_of_cities))
+
+
+def _seconds(times):
+    times = pd.to_datetime(times)
+    if isinstance(times, pd.Timestamp):
+        return np.int64(times.timestamp())
+    return np.asarray(times).astype('datetime64[s]').astype(np.int64)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import audioread
+import numpy as np
+import soundfile
+
+DEFAULT_CACHE_LOCATION = Path('cache/decoded_audio')
+DEFAULT_SEEK_INDEX_LOCATION = Path('cache/seek_index')
+
+
+class AudioCache:
+    # decoded float32 audio as .npy files shared by every process and run. files are named by a hash of the
+    # source path, its modification time, the sample rate and the mono flag, so an edited file is decoded again.
+    # the least recently used files are removed once the cache is over maximum_size bytes
+    def __init__(self, location=DEFAULT_CACHE_LOCATION, maximum_size=50 * 2 ** 30):
+        self.location = Path(location)
+        self.maximum_size = maximum_size
+        self.size = None
+
+    def key(self, path, sr, mono=True, offset=0.0, duration=None):
+        if sr is None:
+            raise ValueError('the audio cache needs a fixed sample rate')
+        path = Path(path).resolve()
+        source = f'{path}|{path.stat().st_mtime_ns}|{sr}|{mono}'
+        # a window of the file, whole files keep the keys they had before windows
+        if offset or duration is not None:
+            source += f'|{offset}|{duration}'
+        return hashlib.sha1(source.encode()).hexdigest()
+
+    def file(self, key):
+        return self.location / key[:2] / f'{key}.npy'
+
+    def load(self, path, sr, decode, mono=True, offset=0.0, duration=None):
+        # decode(path, sr, offset=offset, duration=duration) returns (data, rate) like librosa.load and is only called
+        # on a miss, the data comes back memory mapped
+        return self.cached(self.key(path, sr, mono, offset, duration),
+                           lambda: decode(path, sr, offset=offset, duration=duration)[0]), sr
+
+    def cached(self, key, compute):
+        # the array stored under key, compute() fills it on a miss
+        file = self.file(key)
+        try:
+            data = np.load(file, mmap_mode='r')
+            # the modification time is the last use for the eviction order
+            os.utime(file)
+            return data
+        except FileNotFoundError:
+            pass
+
+        self.store(file, np.asarray(compute(), dtype=np.float32))
+        return np.load(file, mmap_mode='r')
+
+    def store(self, file: Path, data: np.ndarray):
+        # written under a temporary name and renamed, so other processes never open a partial file
+        file.parent.mkdir(parents=True, exist_ok=True)
+        temporary = file.with_name(f'{file.stem}.{os.getpid()}.tmp.npy')
+        np.save(temporary, data)
+        os.replace(temporary, file)
+
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.files())
+        else:
+            self.size += data.nbytes
+        if self.size > self.maximum_size:
+            self.evict()
+
+    def files(self):
+        # (last use, size, file) of every cached file, other processes may remove files while this runs
+        files = []
+        for file in self.location.glob('*/*.npy'):
+            if file.name.endswith('.tmp.npy'):
+                continue
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+        return files
+
+    def evict(self):
+        # oldest use first until the cache is back under its size, files open in other processes may not be removable
+        files = self.files()
+        self.size = sum(size for _, size, _ in files)
+        for _, size, file in sorted(files):
+            if self.size <= self.maximum_size:
+                break
+            try:
+                file.unlink()
+                self.size -= size
+            except OSError:
+                continue
+
+
+def audio_info(path):
+    # (duration in seconds, native sample rate) from the file header. libsndfile reads wav, flac, ogg and newer
+    # versions mp3, anything else goes through audioread like librosa does
+    try:
+        info = soundfile.info(str(path))
+        return info.duration, info.samplerate
+    except RuntimeError:
+        with audioread.audio_open(str(path)) as audio_file:
+            return audio_file.duration, audio_file.samplerate
+
+
+class SeekIndex:
+    # the length and native sample rate of every audio file, read once and kept on disk next to the audio cache, so a
+    # window can be placed in a track and decoded with librosa.load's offset and duration without decoding the track.
+    # one small file per audio file so workers never rewrite a shared index
+    def __init__(self, location=DEFAULT_SEEK_INDEX_LOCATION):
+        self.location = Path(location)
+        self.files = {}
+
+    def info(self, path):
+        path = Path(path).resolve()
+        key = hashlib.sha1(f'{path}|{path.stat().st_mtime_ns}'.encode()).hexdigest()
+        if key in self.files:
+            return self.files[key]
+
+        file = self.location / key[:2] / f'{key}.json'
+        try:
+            with open(file, 'r') as infile:
+                info = json.load(infile)
+        except FileNotFoundError:
+            duration, sr = audio_info(path)
+            info = {'duration': duration, 'sr': sr}
+            file.parent.mkdir(parents=True, exist_ok=True)
+            temporary = file.with_name(f'{key}.{os.getpid()}.tmp')
+            with open(temporary, 'w') as outfile:
+                json.dump(info, outfile)
+            os.replace(temporary, file)
+
+        self.files[key] = info
+        return info
+
+    def samples(self, path, sr):
+        # the length of the file at sample rate sr
+        return int(self.info(path)['duration'] * sr)
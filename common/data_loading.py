@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import torch
+
+# defaults for create_data_loader, the build_network scripts override them with their own loader_config.
+# scripts without an if __name__ == '__main__' guard must keep 0 workers as spawned workers re-import them
+DEFAULT_LOADER_CONFIG = {
+    # None uses every core but one, which is left for the training loop
+    'num_workers': 0,
+    # None pins when training on cuda
+    'pin_memory': None,
+    'persistent_workers': True,
+    'prefetch_factor': 2,
+}
+
+
+def seed_worker(worker_id: int):
+    # torch seeds random and torch in each worker but numpy starts from the same state in all of them
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
+def create_data_loader(dataset, batch_size=1, shuffle=False, sampler=None, device='cpu', loader_config=None,
+                       **kwargs):
+    config = {**DEFAULT_LOADER_CONFIG, **(loader_config or {})}
+
+    num_workers = config['num_workers']
+    if num_workers is None:
+        num_workers = max((os.cpu_count() or 1) - 1, 0)
+    pin_memory = config['pin_memory']
+    if pin_memory is None:
+        pin_memory = str(device).startswith('cuda') and torch.cuda.is_available()
+
+    # worker only settings, DataLoader rejects them without workers
+    worker_settings = {}
+    if num_workers > 0:
+        worker_settings = {'persistent_workers': config['persistent_workers'],
+                           'prefetch_factor': config['prefetch_factor'],
+                           'worker_init_fn': seed_worker}
+
+    return torch.utils.data.DataLoader(dataset,
+                                       batch_size=batch_size,
+                                       shuffle=shuffle,
+                                       sampler=sampler,
+                                       num_workers=num_workers,
+                                       pin_memory=pin_memory,
+                                       **worker_settings,
+                                       **kwargs)
@@ -0,0 +1,67 @@
+import torch
+
+
+class Evaluator:
+    # top k hit rate, loss and calibration over a loader. totals stay as tensors on the device and are only
+    # read back in compute, so scoring a batch never waits on the device
+    def __init__(self, k=1, number_of_bins=10):
+        self.k = k
+        self.number_of_bins = number_of_bins
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.hits = 0
+        self.loss = 0
+        self.bin_count = 0
+        self.bin_confidence = 0
+        self.bin_correct = 0
+
+    def update(self, logits: torch.Tensor, targets: torch.Tensor, loss: torch.Tensor = None):
+        # logits are batch x classes, or batch x 1 for a binary label. targets are class indices, one hot
+        # vectors or 0/1 labels. loss is the mean loss of the batch. returns the metrics of this batch
+        batch_size = targets.shape[0]
+        logits = logits.detach().reshape(batch_size, -1).float()
+
+        if logits.shape[1] == 1:
+            probability = torch.sigmoid(logits[:, 0])
+            predicted = (probability > 0.5).long()
+            correct = predicted == targets.reshape(-1).long()
+            hits = correct
+            confidence = torch.where(predicted == 1, probability, 1 - probability)
+        else:
+            labels = targets.argmax(-1) if targets.dim() > 1 else targets.long()
+            top_logits, top_classes = logits.topk(max(min(self.k, logits.shape[1]), 1), -1)
+            # a row masked to -inf everywhere has nothing to predict, it counts as a miss with confidence 0
+            normaliser = torch.logsumexp(logits, -1)
+            scored = torch.isfinite(normaliser)
+            hits = (top_classes == labels.unsqueeze(-1)).any(-1) & scored
+            # softmax probability of the top class without building the whole softmax
+            confidence = torch.where(scored, torch.exp(top_logits[:, 0] - normaliser), torch.zeros_like(normaliser))
+            correct = (top_classes[:, 0] == labels) & scored
+
+        bins = (confidence * self.number_of_bins).long().clamp(max=self.number_of_bins - 1)
+        self.bin_count = self.bin_count + torch.bincount(bins, minlength=self.number_of_bins)
+        self.bin_confidence = self.bin_confidence + torch.bincount(bins, confidence, minlength=self.number_of_bins)
+        self.bin_correct = self.bin_correct + torch.bincount(bins, correct.float(), minlength=self.number_of_bins)
+
+        self.count += batch_size
+        self.hits = self.hits + hits.sum()
+        batch = {'hit_rate': hits.float().mean()}
+        if loss is not None:
+            self.loss = self.loss + loss.detach() * batch_size
+            batch['loss'] = loss.detach()
+
+        return batch
+
+    def compute(self):
+        # every metric is averaged over samples
+        count = max(self.count, 1)
+        bin_count = torch.as_tensor(self.bin_count).float()
+        calibration_error = (torch.as_tensor(self.bin_correct) - torch.as_tensor(self.bin_confidence)).abs().sum() / count
+        return {'hit_rate': float(self.hits) / count,
+                'loss': float(self.loss) / count,
+                'calibration_error': float(calibration_error),
+                'confidence': float(torch.as_tensor(self.bin_confidence).sum()) / count,
+                'bin_accuracy': (torch.as_tensor(self.bin_correct) / bin_count.clamp(min=1)).tolist(),
+                'count': self.count}
@@ -0,0 +1,26 @@
+import torch
+
+from common.evaluation import Evaluator
+
+# Checks Evaluator against the metrics worked out by hand, including rows masked to -inf everywhere
+inf = float('inf')
+logits = torch.tensor([[2.0, 1.0, -inf, 0.0],
+                       [-inf, -inf, -inf, -inf],
+                       [0.0, -inf, 3.0, -inf],
+                       [-inf, -inf, -inf, -inf]])
+targets = torch.tensor([1, 0, 2, 3])
+
+for k, hit_rate in [(1, 0.25), (2, 0.5)]:
+    evaluator = Evaluator(k=k)
+    batch = evaluator.update(logits, targets, loss=torch.tensor(1.0))
+    metrics = evaluator.compute()
+    print(f"k: {k}.. hit rate: {metrics['hit_rate']:.3f}.. calibration error: {metrics['calibration_error']:.3f}")
+
+    assert metrics['count'] == 4
+    assert abs(metrics['hit_rate'] - hit_rate) < 1e-6
+    assert abs(float(batch['hit_rate']) - hit_rate) < 1e-6
+    # the two masked rows land in the first bin with confidence 0 and no correct prediction
+    assert metrics['bin_accuracy'][0] == 0
+    expected_confidence = (torch.softmax(logits[0], 0)[0] + torch.softmax(logits[2], 0)[2]) / 4
+    assert abs(metrics['confidence'] - float(expected_confidence)) < 1e-6
+    assert all(x == x for x in metrics.values() if isinstance(x, float))
@@ -0,0 +1,63 @@
+from functools import lru_cache
+
+import librosa
+import numpy as np
+import torch
+import torch.nn as nn
+from scipy.signal import get_window
+
+
+@lru_cache(maxsize=None)
+def mel_filterbank(sr, n_fft, n_mels):
+    # n_mels x (n_fft // 2 + 1), the filters librosa.feature.melspectrogram uses
+    return torch.from_numpy(librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)).float()
+
+
+@lru_cache(maxsize=None)
+def named_window(window, n_fft):
+    # periodic like librosa's windows
+    return torch.from_numpy(get_window(window, n_fft, fftbins=True)).float()
+
+
+class MelSpectrogram(nn.Module):
+    # librosa.feature.melspectrogram for a whole batch of equal length waveforms as one stft and one matmul, on the
+    # device the module is on. takes batch x samples and returns batch x n_mels x frames. window is a name or an array.
+    # with center=False the waveforms are frame_window crops that already hold the padding of a centred stft
+    def __init__(self, sr, n_fft=2048, hop_length=512, window='hann', n_mels=128, power=2.0, center=True,
+                 pad_mode='reflect'):
+        super(MelSpectrogram, self).__init__()
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.power = power
+        self.center = center
+        self.pad_mode = pad_mode
+
+        if isinstance(window, str):
+            window = named_window(window, n_fft)
+        else:
+            window = torch.as_tensor(np.asarray(window), dtype=torch.float32)
+        self.register_buffer('window', window, persistent=False)
+        self.register_buffer('filterbank', mel_filterbank(sr, n_fft, n_mels), persistent=False)
+
+    def forward(self, waveforms: torch.Tensor) -> torch.Tensor:
+        stft = torch.stft(waveforms.float(), self.n_fft,
+                          hop_length=self.hop_length,
+                          window=self.window,
+                          center=self.center,
+                          pad_mode=self.pad_mode,
+                          return_complex=True)
+        return torch.matmul(self.filterbank, stft.abs() ** self.power)
+
+
+def frame_window(data, start, frames, n_fft, hop_length):
+    # the samples a centred stft of the whole track reads for frames start to start + frames, so an uncentred stft
+    # of them gives exactly those frames. only the ends of the track are reflect padded, like librosa does, and a
+    # track shorter than the window is zero padded after that
+    half = n_fft // 2
+    first = start * hop_length - half
+    last = first + (frames - 1) * hop_length + n_fft
+    window = data[max(first, 0):min(last, len(data))]
+
+    right = last - min(last, len(data))
+    window = np.pad(window, (max(-first, 0), min(right, half)), mode='reflect')
+    return np.pad(window, (0, right - min(right, half)))
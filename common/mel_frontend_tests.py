@@ -0,0 +1,45 @@
+import librosa
+import numpy as np
+import torch
+from scipy.signal.windows import hamming
+
+from common.mel_frontend import MelSpectrogram, frame_window
+
+# Compares the torch mel frontend with librosa.feature.melspectrogram for the settings each dataset uses
+sample_rate = 22050
+batch_size = 4
+tolerance = 1e-4
+settings = {
+    'bird_sounds': {'n_fft': 2048, 'hop_length': 512, 'window': 'hann', 'n_mels': 224, 'frames': 224},
+    'song_clustering': {'n_fft': 2048, 'hop_length': 512, 'window': hamming(2048, sym=False), 'n_mels': 256, 'frames': 520},
+    'spectrogram': {'n_fft': 2048, 'hop_length': 512, 'window': hamming(2048, sym=False), 'n_mels': 512, 'frames': 512},
+}
+
+rng = np.random.default_rng(1994)
+for name, setting in settings.items():
+    frames = setting.pop('frames')
+    length = frames * setting['hop_length']
+
+    # a chirp with noise so every mel band has some energy
+    time = np.arange(length) / sample_rate
+    waveforms = np.sin(2 * np.pi * (50 + 2000 * time) * time) + 0.1 * rng.standard_normal((batch_size, length))
+    waveforms = waveforms.astype(np.float32)
+
+    expected = np.stack([librosa.feature.melspectrogram(y=waveform, sr=sample_rate, pad_mode='reflect', **setting)
+                         for waveform in waveforms])
+    with torch.no_grad():
+        output = MelSpectrogram(sample_rate, **setting)(torch.from_numpy(waveforms)).numpy()
+
+        # the uncentred frontend on frame_window crops from the middle to the end of the waveforms, as the datasets
+        # crop them with raw_audio
+        start = frames // 2
+        windows = np.stack([frame_window(waveform, start, expected.shape[-1] - start, setting['n_fft'],
+                                         setting['hop_length'])
+                            for waveform in waveforms])
+        cropped = MelSpectrogram(sample_rate, center=False, **setting)(torch.from_numpy(windows)).numpy()
+
+    for frontend, result, reference in [('whole', output, expected), ('frame_window', cropped, expected[:, :, start:])]:
+        error = np.abs(result - reference).max() / np.abs(reference).max()
+        print(f"{name} {frontend}.. shape: {result.shape}.. librosa: {reference.shape}.. max relative error: {error:.2e}")
+        assert result.shape == reference.shape
+        assert error < tolerance
@@ -0,0 +1,96 @@
+import copy
+import time
+
+import torch
+from torch import optim
+
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+class TrainingPrecision:
+    # autocast, channels_last and loss scaling for a training loop of a conv model, 'fp32' leaves the loop as it was.
+    # bfloat16 has the range of float32 so only float16 on cuda needs the gradient scaler
+    def __init__(self, precision='fp32', device='cpu', channels_last=None):
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
+        self.device_type = torch.device(device).type
+        # channels_last lets the reduced precision convolutions skip a layout change on every call
+        self.channels_last = self.dtype is not None if channels_last is None else channels_last
+        self.scaler = None
+        if precision == 'fp16' and self.device_type == 'cuda':
+            self.scaler = torch.amp.GradScaler('cuda')
+
+    def model(self, model: torch.nn.Module):
+        if self.channels_last:
+            return model.to(memory_format=torch.channels_last)
+        return model
+
+    def inputs(self, inputs: torch.Tensor):
+        if self.channels_last:
+            return inputs.contiguous(memory_format=torch.channels_last)
+        return inputs
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.dtype is not None)
+
+    def step(self, loss: torch.Tensor, optimizer: optim.Optimizer):
+        # backward and optimizer step, through the scaler when there is one
+        if self.scaler is None:
+            loss.backward()
+            optimizer.step()
+            return
+        self.scaler.scale(loss).backward()
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+
+def benchmark_precision(model, loss_function, inputs, targets, precision, device, steps=10):
+    # seconds per training step and memory in bytes of a copy of model trained on one batch, model is left as it
+    # is. loss_function(output, targets) is the loss of the training loop and the optimizer is a plain SGD step, so
+    # only the forward and backward passes differ between precisions. the memory is the allocator's peak,
+    # max_memory_allocated, on cuda. cpu has no such counter so there it is the largest size of the tensors autograd
+    # saves for backward in a step, which is the part of the memory that grows with the batch and the part reduced
+    # precision halves
+    training = TrainingPrecision(precision, device)
+    model = training.model(copy.deepcopy(model).to(device))
+    model.train()
+    optimizer = optim.SGD(model.parameters(), lr=0)
+    inputs, targets = training.inputs(inputs.to(device)), targets.to(device)
+
+    saved = [0]
+
+    def pack(tensor):
+        saved[-1] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    cuda = training.device_type == 'cuda'
+    # the first step warms up kernels and allocations and isn't timed
+    for step in range(steps + 1):
+        if step == 1:
+            if cuda:
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            start = time.perf_counter()
+        saved.append(0)
+        optimizer.zero_grad()
+        with training.autocast(), torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            output = model(inputs)
+        loss = loss_function(output.float(), targets)
+        training.step(loss, optimizer)
+
+    if cuda:
+        torch.cuda.synchronize()
+    seconds = (time.perf_counter() - start) / steps
+    return seconds, torch.cuda.max_memory_allocated() if cuda else max(saved)
+
+
+def report_precision(model, loss_function, inputs, targets, precision, device, steps=10):
+    # prints the step time and memory of precision against fp32, see benchmark_precision for what the memory is
+    memory_name = 'peak memory' if torch.device(device).type == 'cuda' else 'saved activations'
+    results = {}
+    for name in dict.fromkeys(['fp32', precision]):
+        results[name] = benchmark_precision(model, loss_function, inputs, targets, name, device, steps)
+        seconds, memory = results[name]
+        print(f"{name}.. step time: {seconds * 1000:.1f}ms.. {memory_name}: {memory / 2 ** 20:.1f}MiB.. "
+              f"speed up: {results['fp32'][0] / seconds:.2f}x.. {memory_name}: {memory / results['fp32'][1]:.2f}x of fp32")
+    return results
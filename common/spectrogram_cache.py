@@ -0,0 +1,50 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from common import data_loading
+from common.audio_cache import AudioCache
+
+DEFAULT_SPECTROGRAM_LOCATION = Path('cache/spectrograms')
+
+
+class SpectrogramCache(AudioCache):
+    # mel spectrograms as memory mapped .npy files, named by the decoded audio they come from and the stft
+    # settings, so changing n_fft, the hop, the window or n_mels computes them again instead of reading stale ones
+    def __init__(self, location=DEFAULT_SPECTROGRAM_LOCATION, maximum_size=50 * 2 ** 30):
+        super().__init__(location, maximum_size)
+
+    def spectrogram_key(self, path, sr, n_fft, hop_length, window, n_mels, offset=0.0, duration=None):
+        # window is a name or the window array itself, offset and duration are the decoded part of the file
+        if isinstance(window, np.ndarray):
+            window = hashlib.sha1(np.ascontiguousarray(window).tobytes()).hexdigest()
+        source = f'{self.key(path, sr, offset=offset, duration=duration)}|{n_fft}|{hop_length}|{window}|{n_mels}'
+        return hashlib.sha1(source.encode()).hexdigest()
+
+    def load(self, path, sr, compute, n_fft, hop_length, window, n_mels, offset=0.0, duration=None):
+        # compute() returns the n_mels x frames spectrogram and is only called on a miss
+        return self.cached(self.spectrogram_key(path, sr, n_fft, hop_length, window, n_mels, offset, duration), compute)
+
+
+class SpectrogramPrecompute(torch.utils.data.Dataset):
+    # calls load_spectrogram for every key so the loader workers fill the cache in parallel
+    def __init__(self, load_spectrogram, keys):
+        self.load_spectrogram = load_spectrogram
+        self.keys = list(keys)
+
+    def __getitem__(self, index):
+        return self.load_spectrogram(self.keys[index]).shape[1]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def precompute_spectrograms(load_spectrogram, keys, loader_config=None):
+    # fills the cache ahead of training, load_spectrogram is the bound method of a dataset. returns the number of frames
+    precompute_loader = data_loading.create_data_loader(SpectrogramPrecompute(load_spectrogram, keys),
+                                                        batch_size=None,
+                                                        loader_config={**(loader_config or {}),
+                                                                       'persistent_workers': False})
+    return sum(frames for frames in precompute_loader)
@@ -7,6 +7,8 @@ import torch
 import torch.nn as nn
 from torch import tensor
 
+from common.audio_cache import AudioCache, SeekIndex
+
 
 def load_metadata(path: Path):
     files = [x for x in path.glob("*.mp3")]
@@ -14,10 +16,13 @@ def load_metadata(path: Path):
     return metadata
 
 
-def load_sound_file(path, sr):
+def load_sound_file(path, sr, offset=0.0, duration=None):
+    # offset and duration in seconds, only that part of the file is decoded
     try:
         data, rate = librosa.load(path,
-                                  sr=sr)
+                                  sr=sr,
+                                  offset=offset,
+                                  duration=duration)
 
     except Exception as e:
         print(f"Reading of sample {path.name} failed")
@@ -41,7 +46,7 @@ def create_output(model: nn.Module, switches: list):
 
 
 class SongIngestion(torch.utils.data.Dataset):
-    def __init__(self, folder, length, transformations, sr, seed=1994):
+    def __init__(self, folder, length, transformations, sr, seed=1994, audio_cache=None, seek_index=None):
         super(SongIngestion).__init__()
         self.metadata = load_metadata(folder)
 
@@ -50,9 +55,8 @@ class SongIngestion(torch.utils.data.Dataset):
 
         self.start = 0
         self.end = self.metadata.shape[0]
-        self.sound_files = {}
-        self.n = 0
-        self.print_n = 0
+        self.audio_cache = audio_cache or AudioCache()
+        self.seek_index = seek_index or SeekIndex()
         self.length = length
         self.transformations = transformations
         self.sr = sr
@@ -63,37 +67,27 @@ class SongIngestion(torch.utils.data.Dataset):
         return output
 
     def load_sound_file(self, itemid):
-        if itemid not in self.sound_files:
-            if self.print_n % 100 == 0:
-                self.metadata.iloc[itemid, 0]
-            self.print_n += 1
-            self.sound_files[itemid] = load_sound_file(self.metadata.iloc[itemid, 0], self.sr)
-        return self.sound_files[itemid]
-
-    def subsample(self, sample):
-        # start = rand.randint(0, len(sample) - self.length)
+        # only the window subsample keeps is decoded, the seek index places it without decoding the track
+        path = self.metadata.iloc[itemid, 0]
+        start = self.subsample(self.seek_index.samples(path, self.sr))
+        return self.audio_cache.load(path, self.sr, load_sound_file, offset=start / self.sr, duration=self.length / self.sr)
+
+    def subsample(self, number_of_samples):
+        # start = rand.randint(0, number_of_samples - self.length)
         # maximum starting point for the sample to ensure we have the right amount of data after it
-        maximum_start = len(sample) - self.length
+        maximum_start = max(number_of_samples - self.length, 0)
         # Start either 45 seconds into the sample or the latest where we can get a full sample
         start = min(22050*45, maximum_start)
-        sample = sample[start:(start + self.length)]
-        return sample
+        return start
 
     def load_sample(self, index):
         sample, rate = self.load_sound_file(index)
-        sample = self.subsample(sample)
+        # the decoded window can be a few samples off length after resampling, or short for a short track
+        sample = np.pad(sample[:self.length], (0, max(self.length - len(sample), 0)))
         sample = tensor(sample).float()
         # sample = self.transformations(sample)
         return sample
 
-    def __next__(self):
-        if self.n <= self.end:
-            sample = self.load_sample(self.n)
-            self.n += 1
-            return sample, self.onehot(self.n)
-        else:
-            raise StopIteration
-
     def __getitem__(self, index):
         sample = self.load_sample(index)
         return sample, self.onehot(index)
@@ -2,6 +2,9 @@ import json
 from pathlib import Path
 
 from create_music.spectrogram import helper_functions
+from common import data_loading
+from common import spectrogram_cache
+from common.mixed_precision import TrainingPrecision, report_precision
 import torch
 from torch import nn
 from torch import optim
@@ -14,13 +17,6 @@ genre = 'Rock'
 fma_base = Path('fma/data/fma_metadata')
 AUDIO_DIR = Path('../data/fma_' + fma_set)
 folder = fma_base / 'tracks.csv'
-tracks = fmautils.load(fma_base / 'tracks.csv')
-fma_subset = tracks[tracks['set', 'subset'] <= fma_set]
-fma_subset = fma_subset.copy()
-fma_subset[('path', '')] = fma_subset.index.map(lambda x: Path(fmautils.get_audio_path(AUDIO_DIR, x)))
-
-fma_subset_sample = fma_subset[fma_subset[('track', 'genre_top')] == genre]
-fma_subset_sample = fma_subset_sample.sample(128, random_state=10)
 
 device = 'cuda'
 sample_length = 32768
@@ -36,24 +32,55 @@ maximum_sample_location = 4096
 y_size = 512
 n_mels = 512
 batch_size = 32
+# DataLoader workers, pinned memory and prefetching, see common.data_loading
+loader_config = {'num_workers': None, 'pin_memory': None, 'persistent_workers': True, 'prefetch_factor': 2}
+# fill the spectrogram cache in parallel before the first epoch instead of during it
+precompute_spectrograms = True
+# 'torch' loads raw audio and computes the mel spectrograms of each collated batch on the device instead of librosa
+frontend = 'librosa'
+# 'bf16' trains under autocast in bfloat16 with channels_last inputs, 'fp16' in float16 with a gradient scaler on cuda
+precision = 'fp32'
+# print the step time and memory (peak on cuda, saved activations on cpu) of precision against fp32 on the first batch
+compare_precision = False
+# a store written by precompute_spectrograms.py to train on every track in it instead of the 128 sampled tracks
+store_location = None
+
+
+def create_dataset(transformations):
+    if store_location is not None:
+        return helper_functions.PrecomputedSongIngestion(store_location,
+                                                         sample_length=sample_length,
+                                                         transformations=transformations,
+                                                         y_size=y_size,
+                                                         maximum_sample_location=maximum_sample_location)
+
+    tracks = fmautils.load(fma_base / 'tracks.csv')
+    fma_subset = tracks[tracks['set', 'subset'] <= fma_set]
+    fma_subset = fma_subset.copy()
+    fma_subset[('path', '')] = fma_subset.index.map(lambda x: Path(fmautils.get_audio_path(AUDIO_DIR, x)))
+
+    fma_subset_sample = fma_subset[fma_subset[('track', 'genre_top')] == genre]
+    fma_subset_sample = fma_subset_sample.sample(128, random_state=10)
+
+    dataset = helper_functions.SongIngestion(fma_subset_sample,
+                                             sample_length=sample_length,
+                                             transformations=transformations,
+                                             sr=sample_rate,
+                                             window_length=window_length,
+                                             y_size=y_size,
+                                             n_mels=n_mels,
+                                             maximum_sample_location=maximum_sample_location,
+                                             raw_audio=frontend == 'torch')
+    if precompute_spectrograms and frontend != 'torch':
+        spectrogram_cache.precompute_spectrograms(dataset.load_spectrogram, dataset.indexes, loader_config)
+    return dataset
+
+
+def load_model():
+    # the last saved model and its metadata, or a new model
+    if not config_file.exists():
+        return helper_functions.SoundGenerator(), {}, 0
 
-transformations = transforms.transforms.Compose([
-    # transforms.transforms.Normalize(mean=[0.485, 0.456, 0.406],
-    #                                 std=[0.229, 0.224, 0.225])
-])
-
-train_loader = torch.utils.data.DataLoader(
-    helper_functions.SongIngestion(fma_subset_sample,
-                                   sample_length=sample_length,
-                                   transformations=transformations,
-                                   sr=sample_rate,
-                                   window_length=window_length,
-                                   y_size=y_size,
-                                   n_mels=n_mels,
-                                   maximum_sample_location=maximum_sample_location),
-    batch_size=batch_size)
-
-if config_file.exists():
     with open(config_file, 'r') as outfile:
         metadata = json.load(outfile)
 
@@ -64,58 +91,89 @@ if config_file.exists():
             model_path = value['path']
             epoch = int(key)
 
-    model = torch.load(model_path)
-
-else:
-    model = helper_functions.SoundGenerator()
-    metadata = {}
-    epoch = 0
-
-
-optimizer = optim.Adam(model.parameters(), lr=0.005)
-criterion = nn.L1Loss()
-model.to(device)
+    return torch.load(model_path), metadata, epoch
 
-steps = 0
-running_loss = 0
-max_epoch = epoch + epochs_to_run
 
-while epoch < max_epoch:
-    train_loader.dataset.shuffle()
+def train_epoch(model, train_loader, optimizer, criterion, training, mel_spectrogram=None):
+    # one pass over the tracks, returns the sum of the batch losses
     running_loss = 0
     model.train()
     for results in train_loader:
-        steps += 1
         results = results.to(device)
+        if mel_spectrogram is not None:
+            results = train_loader.dataset.spectrogram_batch(mel_spectrogram(results))
+        results = training.inputs(results)
         optimizer.zero_grad()
-        logps = model(results)
+        with training.autocast():
+            logps = model(results)
+        # the loss in float32 whatever precision the model ran in
+        logps = logps.float()
         # logps = logps.reshape([logps.shape[0], y_size, n_mels])
         loss = criterion(logps, results.type_as(logps))
-        loss.backward()
-        optimizer.step()
+        training.step(loss, optimizer)
         running_loss += loss.item()
+    return running_loss
+
+
+# the DataLoader workers re-import this module when processes are spawned
+if __name__ == '__main__':
+    transformations = transforms.transforms.Compose([
+        # transforms.transforms.Normalize(mean=[0.485, 0.456, 0.406],
+        #                                 std=[0.229, 0.224, 0.225])
+    ])
+
+    dataset = create_dataset(transformations)
+
+    mel_spectrogram = None
+    if dataset.raw_audio:
+        mel_spectrogram = dataset.mel_frontend().to(device)
+
+    train_loader = data_loading.create_data_loader(dataset,
+                                                   batch_size=batch_size,
+                                                   shuffle=True,
+                                                   device=device,
+                                                   loader_config=loader_config)
+
+    model, metadata, epoch = load_model()
+
+    training = TrainingPrecision(precision, device)
+    model = training.model(model.to(device))
+    optimizer = optim.Adam(model.parameters(), lr=0.005)
+    criterion = nn.L1Loss()
+
+    if compare_precision:
+        results = next(iter(train_loader)).to(device)
+        if mel_spectrogram is not None:
+            results = train_loader.dataset.spectrogram_batch(mel_spectrogram(results))
+        report_precision(model, lambda logps, targets: criterion(logps, targets.type_as(logps)), results, results,
+                         precision, device)
+
+    max_epoch = epoch + epochs_to_run
+
+    while epoch < max_epoch:
+        running_loss = train_epoch(model, train_loader, optimizer, criterion, training, mel_spectrogram)
 
-    print(f"Epoch {epoch}/{max_epoch}.. "
-          f"Train loss: {running_loss / len(train_loader.dataset):.3f}.. ")
+        print(f"Epoch {epoch}/{max_epoch}.. "
+              f"Train loss: {running_loss / len(train_loader.dataset):.3f}.. ")
 
-    save_path = f'models/{metadata_file}/music_creation_{model_name}_{epoch}.pth'
-    metadata[epoch] = {
-        'running_loss': running_loss / len(train_loader.dataset),
-    }
+        save_path = f'models/{metadata_file}/music_creation_{model_name}_{epoch}.pth'
+        metadata[epoch] = {
+            'running_loss': running_loss / len(train_loader.dataset),
+        }
 
-    if epoch == 0:
-        continue
+        if epoch == 0:
+            continue
 
-    if (epoch % save_every == save_every - 1) | \
-            (metadata[epoch - 1]['running_loss'] - metadata[epoch]['running_loss'] > metadata[epoch]['running_loss'] / 5):
-        Path(save_path).parent.mkdir(exist_ok=True, parents=True)
-        metadata[epoch]['path'] = save_path
-        torch.save(model, save_path)
+        if (epoch % save_every == save_every - 1) | \
+                (metadata[epoch - 1]['running_loss'] - metadata[epoch]['running_loss'] > metadata[epoch]['running_loss'] / 5):
+            Path(save_path).parent.mkdir(exist_ok=True, parents=True)
+            metadata[epoch]['path'] = save_path
+            torch.save(model, save_path)
 
-        # if loader_path.exists():
-        #     torch.save(train_loader, loader_path)
+            # if loader_path.exists():
+            #     torch.save(train_loader, loader_path)
 
-        with open(config_file, 'w') as outfile:
-            json.dump(metadata, outfile)
+            with open(config_file, 'w') as outfile:
+                json.dump(metadata, outfile)
 
-    epoch += 1
+        epoch += 1
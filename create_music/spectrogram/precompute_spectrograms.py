@@ -0,0 +1,56 @@
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+
+from create_music.spectrogram import spectrogram_store
+from fma import utils as fmautils
+
+# Decodes and mel transforms a filtered fma subset across a process pool into a sharded, memory mapped spectrogram
+# store that build_network.py can train on. Running it again resumes from the shards that aren't written yet
+fma_set = 'medium'
+# None keeps every genre
+genre = None
+fma_base = Path('fma/data/fma_metadata')
+AUDIO_DIR = Path('../data/fma_' + fma_set)
+store_location = Path(f'../data/fma_{fma_set}_spectrograms')
+sample_rate = 22050
+window_length = 2048
+n_mels = 512
+shard_size = 256
+# None uses every core
+number_of_processes = None
+
+
+# the pool workers re-import this module when processes are spawned
+if __name__ == '__main__':
+    tracks = fmautils.load(fma_base / 'tracks.csv')
+    tracks = tracks[tracks['set', 'subset'] <= fma_set]
+    if genre is not None:
+        tracks = tracks[tracks[('track', 'genre_top')] == genre]
+    track_ids = tracks.index.sort_values().to_list()
+
+    # the shards are fixed by the track list, so it is part of the settings a resumed run has to match
+    spectrogram_store.check_settings(store_location, {'fma_set': fma_set,
+                                                      'genre': genre,
+                                                      'tracks': len(track_ids),
+                                                      'sr': sample_rate,
+                                                      'window_length': window_length,
+                                                      'n_mels': n_mels,
+                                                      'shard_size': shard_size})
+    shards = [track_ids[start:(start + shard_size)] for start in range(0, len(track_ids), shard_size)]
+    completed = spectrogram_store.completed_shards(store_location)
+    pending = [shard for shard in range(len(shards)) if shard not in completed]
+    print(f"Tracks: {len(track_ids)}.. shards: {len(shards)}.. already written: {len(shards) - len(pending)}")
+
+    work = [(track_id, fmautils.get_audio_path(AUDIO_DIR, track_id)) for shard in pending for track_id in shards[shard]]
+    track_spectrogram = partial(spectrogram_store.track_spectrogram, sr=sample_rate, window_length=window_length, n_mels=n_mels)
+    # workers are replaced now and again so a leak in a decoder doesn't build up over the whole subset
+    with Pool(number_of_processes, maxtasksperchild=64) as pool:
+        results = pool.imap(track_spectrogram, work, chunksize=4)
+        for number, shard in enumerate(pending):
+            shard_index = spectrogram_store.write_shard(store_location, shard, [next(results) for _ in shards[shard]])
+            print(f"Shard {shard} ({number + 1}/{len(pending)}).. "
+                  f"frames: {shard_index['frames'].sum()}.. failed: {(shard_index['error'] != '').sum()}")
+
+    index, failures = spectrogram_store.write_index(store_location)
+    print(f"Spectrograms: {len(index)}.. frames: {index['frames'].sum()}.. failed: {len(failures)}, see failures.csv")
@@ -0,0 +1,120 @@
+import json
+import os
+from pathlib import Path
+
+import audioread
+import librosa
+import numpy as np
+import pandas as pd
+from scipy.signal.windows import hamming
+
+
+def spectrogram_settings(window_length, n_mels):
+    # the stft settings shared by SongIngestion and the precompute
+    return {'n_fft': window_length,
+            'hop_length': round(0.25 * window_length),
+            'window': hamming(window_length, sym=False),
+            'n_mels': n_mels}
+
+
+def track_spectrogram(track, sr, window_length, n_mels):
+    # runs in the pool workers. a file that is missing, fails to decode or is shorter than one window is returned with
+    # its error instead of stopping the pool, any other error is a bug and stops the run
+    track_id, path = track
+    try:
+        data, rate = librosa.load(path, sr=sr)
+    except (OSError, EOFError, RuntimeError, audioread.exceptions.DecodeError) as e:
+        return track_id, None, f'{type(e).__name__}: {e}'
+
+    # empty audio can't be reflect padded and a part of a window has no full frame to transform
+    if len(data) < window_length:
+        return track_id, None, f'too short: {len(data)} samples, a window is {window_length}'
+
+    # reflect padded like the cached spectrograms of SongIngestion
+    spectrogram = librosa.feature.melspectrogram(y=data, sr=rate, pad_mode='reflect', **spectrogram_settings(window_length, n_mels))
+    # frames x n_mels so every track is one contiguous block of its shard
+    return track_id, np.ascontiguousarray(spectrogram.T, dtype=np.float32), ''
+
+
+def shard_file(location: Path, shard: int):
+    return location / f'shard_{shard:05d}.npy'
+
+
+def shard_index_file(location: Path, shard: int):
+    return location / f'shard_{shard:05d}.csv'
+
+
+def check_settings(location: Path, settings: dict):
+    # shards written with other settings or another track list can't be mixed into the same store
+    settings_file = location / 'settings.json'
+    if settings_file.exists():
+        with open(settings_file, 'r') as infile:
+            existing = json.load(infile)
+        if existing != settings:
+            raise ValueError(f'{location} was written with {existing}, use another location for {settings}')
+        return
+
+    location.mkdir(parents=True, exist_ok=True)
+    with open(settings_file, 'w') as outfile:
+        json.dump(settings, outfile)
+
+
+def completed_shards(location: Path):
+    # the shard index is written after its data, so a shard with an index is complete
+    return {int(file.stem.split('_')[1]) for file in location.glob('shard_*.csv')}
+
+
+def write_shard(location: Path, shard: int, results: list):
+    # results are (track_id, spectrogram, error) from track_spectrogram, failed tracks are only kept in the index
+    spectrograms = [spectrogram for _, spectrogram, _ in results if spectrogram is not None]
+    frames = [0 if spectrogram is None else spectrogram.shape[0] for _, spectrogram, _ in results]
+    index = pd.DataFrame({'track_id': [track_id for track_id, _, _ in results],
+                          'shard': shard,
+                          'offset': np.cumsum([0] + frames[:-1]),
+                          'frames': frames,
+                          'error': [error for _, _, error in results]})
+
+    # temporary names and renames, so an interrupted shard is written again from scratch on the next run
+    if spectrograms:
+        temporary = location / f'shard_{shard:05d}.tmp.npy'
+        np.save(temporary, np.concatenate(spectrograms))
+        os.replace(temporary, shard_file(location, shard))
+    temporary = location / f'shard_{shard:05d}.tmp.csv'
+    index.to_csv(temporary, index=False)
+    os.replace(temporary, shard_index_file(location, shard))
+    return index
+
+
+def write_index(location: Path):
+    # combines the shard indexes into index.csv and failures.csv
+    shards = pd.concat([pd.read_csv(shard_index_file(location, shard), keep_default_na=False)
+                        for shard in sorted(completed_shards(location))])
+    failed = shards['error'] != ''
+    index = shards[~failed].drop(columns='error')
+    index.to_csv(location / 'index.csv', index=False)
+    shards[failed].to_csv(location / 'failures.csv', index=False)
+    return index, shards[failed]
+
+
+class SpectrogramStore:
+    # reads a store written by precompute_spectrograms.py. shards are opened memory mapped on first use in each
+    # process, and a spectrogram is a view of its shard
+    def __init__(self, location):
+        self.location = Path(location)
+        with open(self.location / 'settings.json', 'r') as infile:
+            self.settings = json.load(infile)
+        self.index = pd.read_csv(self.location / 'index.csv', index_col='track_id')
+        self.shards = {}
+
+    def __getstate__(self):
+        # DataLoader workers open their own maps instead of being sent a copy of every shard read so far
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def load(self, track_id):
+        # n_mels x frames like librosa.feature.melspectrogram
+        shard, offset, frames = self.index.loc[track_id, ['shard', 'offset', 'frames']]
+        if shard not in self.shards:
+            self.shards[shard] = np.load(shard_file(self.location, shard), mmap_mode='r')
+        return self.shards[shard][offset:offset + frames].T
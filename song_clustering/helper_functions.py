@@ -6,11 +6,18 @@ import torch.nn as nn
 from scipy.signal.windows import hamming
 from torch import tensor
 
+from common.audio_cache import AudioCache
+from common.spectrogram_cache import SpectrogramCache
+from common.mel_frontend import MelSpectrogram, frame_window
 
-def load_sound_file(path, sr):
+
+def load_sound_file(path, sr, offset=0.0, duration=None):
+    # offset and duration in seconds, only that part of the file is decoded
     try:
         data, rate = librosa.load(path,
-                                  sr=sr)
+                                  sr=sr,
+                                  offset=offset,
+                                  duration=duration)
 
     except Exception as e:
         print(f"Reading of sample {path.name} failed")
@@ -35,7 +42,8 @@ def create_output(model: nn.Module, switches: list):
 
 class SongIngestion(torch.utils.data.Dataset):
     def __init__(self, metadata, sample_length, transformations, sr, window_length,
-                 y_size, n_mels, maximum_sample_location, seed=1994):
+                 y_size, n_mels, maximum_sample_location, seed=1994, audio_cache=None,
+                 spectrogram_cache=None, raw_audio=False, random_crop=True):
         super(SongIngestion).__init__()
         self.metadata = metadata
         self.n_mels = n_mels
@@ -47,14 +55,23 @@ class SongIngestion(torch.utils.data.Dataset):
         self.start = 0
         self.end = self.metadata.shape[0]
         self.y_size = y_size
-        self.sound_files = {}
-        self.n = 0
-        self.print_n = 0
+        self.audio_cache = audio_cache or AudioCache()
+        self.spectrogram_cache = spectrogram_cache or SpectrogramCache()
         self.length = sample_length
         self.transformations = transformations
+        # samples are waveforms and spectrogram_batch makes the spectrograms after collation
+        self.raw_audio = raw_audio
+        # crops start at random before maximum_sample_location instead of at the start of the track
+        self.random_crop = random_crop
         self.sr = sr
         self.window_length = window_length
         self.window = hamming(self.window_length, sym=False)
+        self.spectrogram_settings = {'n_fft': self.window_length,
+                                     'hop_length': round(0.25 * self.window_length),
+                                     'window': self.window,
+                                     'n_mels': self.n_mels}
+        # subsample never reads past frame maximum_sample_location + y_size, so the rest of a track isn't decoded
+        self.duration = ((maximum_sample_location + y_size) * self.spectrogram_settings['hop_length'] + window_length) / sr
 
     def onehot(self, n, maximum):
         output = np.zeros(maximum)
@@ -62,21 +79,18 @@ class SongIngestion(torch.utils.data.Dataset):
         return output
 
     def load_sound_file(self, itemid):
-        if itemid not in self.sound_files:
-            if self.print_n % 100 == 0:
-                self.metadata.iloc[itemid, -1]
-            self.print_n += 1
-            self.sound_files[itemid] = load_sound_file(self.metadata.iloc[itemid, -1], self.sr)
-        return self.sound_files[itemid]
-
-    def load_spectrogram(self, data, rate):
-        frequency_graph = librosa.feature.melspectrogram(data,
-                                                         sr=rate,
-                                                         n_fft=self.window_length,
-                                                         hop_length=round(0.25 * self.window_length),
-                                                         window=self.window,
-                                                         n_mels=self.n_mels)
-        return frequency_graph
+        # decoded once per file and shared on disk across workers and runs
+        return self.audio_cache.load(self.metadata.iloc[itemid, -1], self.sr, load_sound_file, duration=self.duration)
+
+    def create_spectrogram(self, itemid):
+        data, rate = self.load_sound_file(itemid)
+        # reflect padded at the ends like the frame_window crops of the torch frontend
+        return librosa.feature.melspectrogram(y=data, sr=rate, pad_mode='reflect', **self.spectrogram_settings)
+
+    def load_spectrogram(self, itemid):
+        # computed on first use, later epochs read the memory mapped spectrogram without decoding or an stft
+        return self.spectrogram_cache.load(self.metadata.iloc[itemid, -1], self.sr, lambda: self.create_spectrogram(itemid),
+                                           duration=self.duration, **self.spectrogram_settings)
 
     def pad_spectrogram(self, sample):
         x, y = sample.shape
@@ -86,16 +100,37 @@ class SongIngestion(torch.utils.data.Dataset):
         # Added a statement to correctly return samples under y_size long
         if sample.shape[1] < self.y_size:
             return self.pad_spectrogram(sample), 0
-        # sample_length = sample.shape[1]
-        # start = rand.randint(0, sample_length - self.y_size)
-        # start = min(self.maximum_sample_location - 1, start)
-        start = 0
+        start = self.crop_start(sample.shape[1])
+        # a view of the cached spectrogram, the stft isn't repeated for a new crop
         sample = sample[:, start:(start + self.y_size)]
         return sample, start
 
+    def crop_start(self, frames):
+        # the first frame of a y_size crop of a track with frames frames
+        if not self.random_crop:
+            return 0
+        return rand.randint(0, max(min(frames - self.y_size, self.maximum_sample_location - 1), 0))
+
+    def load_waveform(self, index):
+        # the audio of the y_size frames subsample takes
+        data, _ = self.load_sound_file(index)
+        start = self.crop_start(len(data) // self.spectrogram_settings['hop_length'] + 1)
+        sample = frame_window(data, start, self.y_size, self.spectrogram_settings['n_fft'], self.spectrogram_settings['hop_length'])
+        return tensor(sample).float(), start
+
+    def mel_frontend(self):
+        # the torch frontend for the load_waveform windows
+        return MelSpectrogram(self.sr, center=False, **self.spectrogram_settings)
+
+    def spectrogram_batch(self, spectrograms: torch.Tensor):
+        # batch x n_mels x y_size from mel_frontend into the batches load_sample makes
+        sample = spectrograms.transpose(1, 2).reshape(-1, 1, self.y_size, self.n_mels)
+        return self.transformations(sample)
+
     def load_sample(self, index):
-        sample, rate = self.load_sound_file(index)
-        sample = self.load_spectrogram(sample, rate)
+        if self.raw_audio:
+            return self.load_waveform(index)
+        sample = self.load_spectrogram(index)
         sample, start_index = self.subsample(sample)
         # added a transpose to match the output of the neural network
         sample = np.transpose(sample)
@@ -104,16 +139,6 @@ class SongIngestion(torch.utils.data.Dataset):
         sample = self.transformations(sample)
         return sample, start_index
 
-    def __next__(self):
-        if self.n < self.end:
-            n = self.n
-            sample, one_hot, sample_location = self.__getitem__(n)
-            self.n += 1
-            return sample, one_hot, sample_location
-        else:
-            self.n = 0
-            raise StopIteration
-
     def __getitem__(self, index):
         sample, start_index = self.load_sample(index)
         return sample, self.onehot(index, self.end), self.onehot(start_index, self.maximum_sample_location)